@@ -0,0 +1,45 @@
+""" Admin listings of the grades models
+
+The list pages join the relations the __str__ methods walk
+(list_select_related), so a page costs the same number of queries no
+matter how many rows it shows.
+"""
+from django.contrib import admin
+
+from grades import models
+
+
+class SemestersAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'name', 'semester_start', 'semester_end')
+    list_select_related = models.SemestersQuerySet.display_related
+    raw_id_fields = ('account',)
+
+class SubjectAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'weight')
+    list_select_related = models.SubjectQuerySet.display_related
+    raw_id_fields = ('account',)
+
+class GradesAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'score', 'weight')
+    list_select_related = models.GradesQuerySet.display_related
+    raw_id_fields = ('subject',)
+    date_hierarchy = 'date'
+
+class RepresentativeAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'bottom', 'top', 'legend')
+    list_select_related = models.RepresentativeQuerySet.display_related \
+        + ('legend',)
+
+class CalculativeAdmin(admin.ModelAdmin):
+    list_select_related = models.CalculativeQuerySet.display_related
+
+class CalculativeDescripAdmin(admin.ModelAdmin):
+    list_select_related = models.CalculativeDescripQuerySet.display_related
+
+
+admin.site.register(models.Semesters, SemestersAdmin)
+admin.site.register(models.Subject, SubjectAdmin)
+admin.site.register(models.Grades, GradesAdmin)
+admin.site.register(models.Representative, RepresentativeAdmin)
+admin.site.register(models.Calculative, CalculativeAdmin)
+admin.site.register(models.CalculativeDescrip, CalculativeDescripAdmin)
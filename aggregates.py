@@ -0,0 +1,153 @@
+""" Maintenance of the SubjectAggregate table
+
+Every grade mutation updates the statistics of the (subject, semester) cells
+it touches inside the caller's transaction. Adding a grade is a single
+UPDATE; removing one only rescans the cell when it held the top score. Cells
+that were never built are rebuilt from the raw grades the first time they are
+touched, so the table fills itself up, and rebuild_all/check_consistency can
+backfill and verify it.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Max, Sum, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from grades import models
+
+# Float sums drift a little when updated in place
+TOLERANCE = 1e-6
+
+
+def reads_enabled():
+    # Only read from the table once it has been backfilled with rebuild_all
+    return getattr(settings, 'GRADES_AGGREGATE_READS', False)
+
+def _semesters_for(account_id, date):
+    return models.Semesters.objects.filter(account_id=account_id,
+                                           semester_start__lte=date,
+                                           semester_end__gte=date)\
+        .values_list('id', flat=True)
+
+def grade_stats(queryset):
+    """ weighted_sum, weight_sum, max_score and count of the grades per
+    subject_id """
+    return queryset.values('subject_id').annotate(
+        weighted_sum=Sum(F('score') * F('weight'), output_field=FloatField()),
+        weight_sum=Sum('weight'), max_score=Max('score'), count=Count('id'))
+
+def rebuild_cell(subject_id, semester_id):
+    semester = models.Semesters.objects.get(id=semester_id)
+    stats = grade_stats(models.Grades.objects.filter(
+        subject_id=subject_id, date__gte=semester.semester_start,
+        date__lte=semester.semester_end))
+    stats = stats[0] if stats else {"weighted_sum": 0, "weight_sum": 0,
+                                     "max_score": 0, "count": 0}
+    models.SubjectAggregate.objects.update_or_create(
+        subject_id=subject_id, semester_id=semester_id,
+        defaults={"weighted_sum": stats["weighted_sum"],
+                  "weight_sum": stats["weight_sum"],
+                  "max_score": stats["max_score"], "count": stats["count"]})
+
+def rebuild_semester(semester):
+    stats = grade_stats(models.Grades.objects.filter(
+        subject__account_id=semester.account_id,
+        date__gte=semester.semester_start, date__lte=semester.semester_end))
+    with transaction.atomic():
+        models.SubjectAggregate.objects.filter(semester=semester).delete()
+        models.SubjectAggregate.objects.bulk_create([
+            models.SubjectAggregate(
+                subject_id=row["subject_id"], semester=semester,
+                weighted_sum=row["weighted_sum"], weight_sum=row["weight_sum"],
+                max_score=row["max_score"], count=row["count"])
+            for row in stats])
+
+def rebuild_all(account_id=None):
+    semesters = models.Semesters.objects.all()
+    if account_id is not None:
+        semesters = semesters.filter(account_id=account_id)
+    for semester in semesters.iterator():
+        rebuild_semester(semester)
+
+def _add(subject_id, semester_id, score, weight):
+    updated = models.SubjectAggregate.objects.filter(
+        subject_id=subject_id, semester_id=semester_id).update(
+            weighted_sum=F('weighted_sum') + score * weight,
+            weight_sum=F('weight_sum') + weight,
+            max_score=Greatest('max_score',
+                               Value(score, output_field=FloatField())),
+            count=F('count') + 1, updated=timezone.now())
+    if not updated:
+        # Cell was never built, the grade is already saved
+        rebuild_cell(subject_id, semester_id)
+
+def _remove(subject_id, semester_id, score, weight):
+    # Returns True when the cell was rebuilt from the raw grades
+    cell = models.SubjectAggregate.objects.select_for_update()\
+        .filter(subject_id=subject_id, semester_id=semester_id).first()
+    if cell is None or cell.count <= 1 or score >= cell.max_score:
+        # The top score can't be taken back out of a running max
+        rebuild_cell(subject_id, semester_id)
+        return True
+    models.SubjectAggregate.objects.filter(id=cell.id).update(
+        weighted_sum=F('weighted_sum') - score * weight,
+        weight_sum=F('weight_sum') - weight,
+        count=F('count') - 1, updated=timezone.now())
+    return False
+
+# The hooks below run after the grade was written, inside the same transaction
+
+def grade_added(account_id, subject_id, date, score, weight):
+    for semester_id in _semesters_for(account_id, date):
+        _add(subject_id, semester_id, float(score), float(weight))
+
+def grade_removed(account_id, subject_id, date, score, weight):
+    for semester_id in _semesters_for(account_id, date):
+        _remove(subject_id, semester_id, float(score), float(weight))
+
+def grade_changed(account_id, old, new):
+    """ old and new are (subject_id, date, score, weight) of the grade """
+    rebuilt = set()
+    subject_id, date, score, weight = old
+    for semester_id in _semesters_for(account_id, date):
+        if _remove(subject_id, semester_id, float(score), float(weight)):
+            rebuilt.add((subject_id, semester_id))
+    subject_id, date, score, weight = new
+    for semester_id in _semesters_for(account_id, date):
+        # A rebuilt cell already contains the new values
+        if (subject_id, semester_id) not in rebuilt:
+            _add(subject_id, semester_id, float(score), float(weight))
+
+def check_consistency(account_id=None, repair=False):
+    """ Compare the table with the raw grades and return the drifting cells
+    as (subject_id, semester_id, stored, expected) tuples, stats being
+    (weighted_sum, weight_sum, max_score, count) """
+    drift = []
+    semesters = models.Semesters.objects.all()
+    if account_id is not None:
+        semesters = semesters.filter(account_id=account_id)
+    for semester in semesters.iterator():
+        expected = {}
+        for row in grade_stats(models.Grades.objects.filter(
+                subject__account_id=semester.account_id,
+                date__gte=semester.semester_start,
+                date__lte=semester.semester_end)):
+            expected[row["subject_id"]] = (row["weighted_sum"],
+                                           row["weight_sum"],
+                                           row["max_score"], row["count"])
+        stored = {}
+        for cell in models.SubjectAggregate.objects.filter(semester=semester):
+            if cell.count > 0:
+                stored[cell.subject_id] = (cell.weighted_sum, cell.weight_sum,
+                                           cell.max_score, cell.count)
+        semester_drift = []
+        for subject_id in set(expected) | set(stored):
+            a = stored.get(subject_id)
+            b = expected.get(subject_id)
+            if a is None or b is None or a[3] != b[3] or \
+                    any(abs(x - y) > TOLERANCE for x, y in zip(a[:3], b[:3])):
+                semester_drift.append((subject_id, semester.id, a, b))
+        if semester_drift and repair:
+            rebuild_semester(semester)
+        drift.extend(semester_drift)
+    return drift
@@ -0,0 +1,337 @@
+""" Grade analytics on NumPy arrays
+
+The grades of an account are loaded once as contiguous arrays (subject,
+date, score, weight, ordered by date). Rolling averages, trends, the grade
+needed to reach a target and distributions are computed on whole arrays
+instead of looping over model instances. The grades of archived semesters
+are included (see archive.grade_values), as long as their subject exists.
+"""
+import heapq
+
+import numpy as np
+
+from grades import archive, back, models, refcache, resolvers
+
+
+class GradeArrays(object):
+    """ Grades of an account as arrays, ordered by date
+
+    ** Contents **
+    subject_ids - subject id of each grade (int64)
+    dates - date of each grade (datetime64[D])
+    scores - score in percent (float64)
+    weights - weight of the grade (float64)
+    """
+    def __init__(self, subject_ids, dates, scores, weights):
+        self.subject_ids = subject_ids
+        self.dates = dates
+        self.scores = scores
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.scores)
+
+    def for_subject(self, subject_id):
+        mask = self.subject_ids == subject_id
+        return GradeArrays(self.subject_ids[mask], self.dates[mask],
+                           self.scores[mask], self.weights[mask])
+
+
+def load_grades(user_id):
+    context = back.get_account_context(user_id)
+    grades = models.Grades.objects\
+        .filter(subject__account_id=context.user_id).order_by('date', 'id')\
+        .values_list('id', 'subject_id', 'date', 'score', 'weight', 'note')
+    subjects = set(back.get_subjects(context).values_list('id', flat=True))
+    rows = [(subject_id, date, score, weight)
+            for _, subject_id, date, score, weight, _ in heapq.merge(
+                grades.iterator(), archive.grade_values(context.user_id),
+                key=lambda row: (row[2], row[0]))
+            if subject_id in subjects]
+    if not rows:
+        return GradeArrays(np.empty(0, dtype=np.int64),
+                           np.empty(0, dtype='datetime64[D]'),
+                           np.empty(0, dtype=np.float64),
+                           np.empty(0, dtype=np.float64))
+    subject_ids, dates, scores, weights = zip(*rows)
+    return GradeArrays(np.array(subject_ids, dtype=np.int64),
+                       np.array(dates, dtype='datetime64[D]'),
+                       np.array(scores, dtype=np.float64),
+                       np.array(weights, dtype=np.float64))
+
+
+############## Mapping percents to grades ###################
+
+def calculate_grades(calculative, percents):
+    """ Vectorized resolvers.calculate_grade """
+    p = np.asarray(percents, dtype=np.float64)
+    grade_range = calculative.top - calculative.bottom
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upper = ((p - calculative.bottom_per) /
+                 (100 - calculative.bottom_per)) * grade_range\
+            + calculative.bottom
+        lower = (p / calculative.bottom_per) * calculative.bottom
+    grades = np.where(p > calculative.bottom_per, upper, lower)
+    grades = np.where(p == 0, calculative.bottom, grades)
+    return np.round(grades, 2)
+
+def percents_for_grades(calculative, grades):
+    """ Inverse of calculate_grades, the percent that gives a grade """
+    g = np.asarray(grades, dtype=np.float64)
+    grade_range = calculative.top - calculative.bottom
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upper = ((g - calculative.bottom) / grade_range) * \
+            (100 - calculative.bottom_per) + calculative.bottom_per
+        lower = g * calculative.bottom_per / calculative.bottom
+    # Grades past the bottom grade (in the direction of top) use the upper
+    # part of the scale, works for both ascending and descending systems
+    return np.where((g - calculative.bottom) * grade_range > 0, upper, lower)
+
+def lookup(table, low, percents):
+    """ Look up percents in a GradeResolver table, None outside of it """
+    values = np.empty(len(table) + 1, dtype=object)
+    values[:-1] = table
+    values[-1] = None
+    index = np.floor(np.asarray(percents, dtype=np.float64)) - low
+    index = np.where(np.isfinite(index), index, -1).astype(np.int64)
+    index = np.where((index >= 0) & (index < len(table)), index, len(table))
+    return values[index]
+
+def representations(resolver, percents):
+    return lookup(resolver.representation_table, resolver.low, percents)
+
+def descriptions(resolver, percents):
+    descrips = lookup(resolver.descrip_table, resolver.low, percents)
+    descrips[np.equal(descrips, None)] = resolver.lowest_descrip
+    return descrips
+
+
+############## Analytics ###################
+
+def rolling_average(grades, window=5):
+    """ Weighted average over the last `window` grades at every grade """
+    weighted = np.cumsum(grades.scores * grades.weights)
+    weight = np.cumsum(grades.weights)
+    weighted[window:] = weighted[window:] - weighted[:-window]
+    weight[window:] = weight[window:] - weight[:-window]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weight != 0, weighted / weight, 0)
+
+def subject_trends(grades):
+    """ Weighted least squares line of score over time per subject.
+    Returns {subject_id: (slope in percent per day, score today, count)} """
+    if len(grades) == 0:
+        return {}
+    subjects, index = np.unique(grades.subject_ids, return_inverse=True)
+    x = (grades.dates - grades.dates[0]).astype(np.float64)
+    y = grades.scores
+    w = grades.weights
+    n = len(subjects)
+    sw = np.bincount(index, w, n)
+    sx = np.bincount(index, w * x, n)
+    sy = np.bincount(index, w * y, n)
+    sxx = np.bincount(index, w * x * x, n)
+    sxy = np.bincount(index, w * x * y, n)
+    counts = np.bincount(index, minlength=n)
+    denominator = sw * sxx - sx * sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = np.where(denominator != 0,
+                          (sw * sxy - sx * sy) / denominator, 0)
+        intercepts = np.where(sw != 0, (sy - slopes * sx) / sw, 0)
+    today = (np.datetime64('today', 'D') - grades.dates[0])\
+        .astype(np.float64)
+    trends = {}
+    for i, subject_id in enumerate(subjects):
+        trends[int(subject_id)] = (float(slopes[i]),
+                                   float(intercepts[i] + slopes[i] * today),
+                                   int(counts[i]))
+    return trends
+
+def _target_percent(context, target):
+    if context.grading_sys.type == 'c':
+        return float(percents_for_grades(context.calculative, target))
+    elif context.grading_sys.type == 'r':
+        for representation in context.representations:
+            if str(representation.id) == str(target) or \
+                    representation.representation == str(target):
+                return float(representation.bottom)
+        raise models.Representative.DoesNotExist(
+            "Representative {} does not exist.".format(target))
+    return float(target)
+
+def grade_needed(user_id, grades, target, weight=1):
+    """ Score needed on the next grade of each subject (with the given
+    weight) to bring the subject average to `target`, given as a grade of the
+    account's grading system. Returns {subject_id: (percent, grade)} with the
+    percent possibly above 100 or below 0 if the target can't be reached """
+    context = back.get_account_context(user_id)
+    if len(grades) == 0:
+        return {}
+    target_percent = _target_percent(context, target)
+    subjects, index = np.unique(grades.subject_ids, return_inverse=True)
+    n = len(subjects)
+    weighted = np.bincount(index, grades.scores * grades.weights, n)
+    weight_sum = np.bincount(index, grades.weights, n)
+    needed = (target_percent * (weight_sum + weight) - weighted) / weight
+    if context.grading_sys.type == 'c':
+        resolved = calculate_grades(context.calculative,
+                                    np.clip(needed, 0, 100))
+    elif context.grading_sys.type == 'r':
+        resolved = representations(context.resolver, np.ceil(needed))
+    else:
+        resolved = needed
+    return dict((int(subject_id), (float(needed[i]), resolved[i]))
+                for i, subject_id in enumerate(subjects))
+
+def distribution(user_id, grades):
+    """ Number of grades per representation (type r) or description
+    (type c) of the account's grading system, and per whole percent """
+    context = back.get_account_context(user_id)
+    percents = np.clip(np.floor(grades.scores), 0, 100).astype(np.int64)
+    per_percent = np.bincount(percents, minlength=101)
+    if context.grading_sys.type == 'c':
+        bands = descriptions(context.resolver, np.arange(101))
+    elif context.grading_sys.type == 'r':
+        bands = representations(context.resolver, np.arange(101))
+    else:
+        return [], per_percent
+    counts = {}
+    order = []
+    for percent in range(101):
+        band = bands[percent]
+        if band is None or not per_percent[percent]:
+            continue
+        if band.id not in counts:
+            counts[band.id] = [band, 0]
+            order.append(band.id)
+        counts[band.id][1] += int(per_percent[percent])
+    return [tuple(counts[id]) for id in order], per_percent
+
+
+############## Grading system conversion ###################
+
+class ConversionPreview(object):
+    """ An account's grade history under another grading system
+
+    ** Contents **
+    grading_sys - target GradingSystem
+    grades - per grade (in GradeArrays order): calculated grade (type c),
+             representation (type r) or percent (type n)
+    bands - per grade: CalculativeDescrip (type c), Representative (type r)
+            or None
+    subjects - {subject_id: average} over all grades of the subject
+    semesters - [{"semester", "subjects": {subject_id: average},
+                 "total_avg"}] like insights_logic
+
+    Averages have the format of the dashboards ({"representation",
+    "legend"} for type c, Representative for type r, percent for type n).
+    """
+    def __init__(self, grading_sys, grades, bands, subjects, semesters):
+        self.grading_sys = grading_sys
+        self.grades = grades
+        self.bands = bands
+        self.subjects = subjects
+        self.semesters = semesters
+
+
+def _weighted_averages(index, n, scores, weights):
+    """ Truncated weighted average per group, as back.make_subject_stats """
+    weighted = np.bincount(index, scores * weights, n)
+    weight_sum = np.bincount(index, weights, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = np.where(weighted != 0, weighted / weight_sum, 0)
+    return np.trunc(averages), np.bincount(index, minlength=n)
+
+def _average_percents(grades, semesters, subject_weights):
+    """ All averages of the account as one array of percents, and the
+    layout to take it apart again: (subject ids, [(semester, subject ids,
+    offset)]) """
+    subject_ids, index = np.unique(grades.subject_ids, return_inverse=True)
+    n = len(subject_ids)
+    overall, _ = _weighted_averages(index, n, grades.scores, grades.weights)
+    parts = [overall]
+    offset = n
+    layout = []
+    for semester in semesters:
+        mask = (grades.dates >= np.datetime64(semester.semester_start)) & \
+            (grades.dates <= np.datetime64(semester.semester_end))
+        averages, counts = _weighted_averages(
+            index[mask], n, grades.scores[mask], grades.weights[mask])
+        present = counts > 0
+        averages = averages[present]
+        weights = np.array([subject_weights.get(int(id), 1)
+                            for id in subject_ids[present]],
+                           dtype=np.float64)
+        # Semester total as back.get_subjects_average
+        total = np.sum(averages * weights) / np.sum(weights) \
+            if np.sum(weights) else 0
+        parts.append(averages)
+        parts.append([np.trunc(total)])
+        layout.append((semester, subject_ids[present], offset))
+        offset += len(averages) + 1
+    return np.concatenate(parts), (subject_ids, layout)
+
+def _resolve_averages(resolver, percents):
+    grading_sys = resolver.grading_sys
+    if grading_sys.type == 'c':
+        grades = calculate_grades(resolver.calculative, percents)
+        descrips = descriptions(resolver, percents)
+        return [{"representation": float(grade),
+                 "legend": descrip.legend if descrip else None}
+                for grade, descrip in zip(grades, descrips)]
+    elif grading_sys.type == 'r':
+        return list(representations(resolver, percents))
+    return [int(percent) for percent in percents]
+
+def _preview(resolver, grades, percents, layout):
+    grading_sys = resolver.grading_sys
+    if grading_sys.type == 'c':
+        converted = calculate_grades(resolver.calculative, grades.scores)
+        bands = descriptions(resolver, grades.scores)
+    elif grading_sys.type == 'r':
+        bands = representations(resolver, grades.scores)
+        names = [r.representation if r is not None else None
+                 for r in resolver.representation_table]
+        converted = lookup(names, resolver.low, grades.scores)
+    else:
+        converted = grades.scores
+        bands = np.empty(len(grades), dtype=object)
+
+    averages = _resolve_averages(resolver, percents)
+    subject_ids, semester_layout = layout
+    subjects = dict((int(id), averages[i])
+                    for i, id in enumerate(subject_ids))
+    semesters = []
+    for semester, ids, offset in semester_layout:
+        semesters.append({
+            "semester": semester,
+            "subjects": dict((int(id), averages[offset + i])
+                             for i, id in enumerate(ids)),
+            "total_avg": averages[offset + len(ids)]})
+    return ConversionPreview(grading_sys, converted, bands, subjects,
+                             semesters)
+
+def convert_preview(user_id, grading_systems=None, grades=None):
+    """ Preview of the account's grades, subject and semester averages under
+    each of the grading systems (instances or ids, default: all of them).
+    The averages are computed once in percent and every target maps the same
+    arrays through its resolver tables, so a target costs no queries once
+    its resolver is cached. Returns a list of ConversionPreview in the order
+    of grading_systems """
+    context = back.get_account_context(user_id)
+    if grading_systems is None:
+        grading_systems = list(refcache.get('grading_systems'))
+    if grades is None:
+        grades = load_grades(context)
+    semesters = list(back.get_semesters(context)
+                     .order_by('semester_start', 'id'))
+    subject_weights = dict(back.get_subjects(context)
+                           .values_list('id', 'weight'))
+    percents, layout = _average_percents(grades, semesters, subject_weights)
+    by_id = resolvers.get_resolvers(grading_systems)
+    previews = []
+    for grading_sys in grading_systems:
+        grading_sys_id = getattr(grading_sys, 'id', grading_sys)
+        previews.append(_preview(by_id[int(grading_sys_id)], grades,
+                                 percents, layout))
+    return previews
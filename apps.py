@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class GradesConfig(AppConfig):
+    name = 'grades'
+
+    def ready(self):
+        # Connect the cache invalidation signals. The data is loaded on
+        # first use, no queries while the app registry is being set up
+        from grades import refcache, resolvers
+        if getattr(settings, 'GRADES_INSTRUMENTATION', False):
+            from grades import instrumentation
+            instrumentation.enable()
@@ -0,0 +1,142 @@
+""" Cold storage of finished semesters
+
+archive_finished() freezes the semesters that ended more than
+GRADES_ARCHIVE_AFTER days ago (default ARCHIVE_AFTER): the per subject
+statistics go into SemesterSummary rows, the raw grades are moved into one
+compressed GradeArchive row per semester and deleted from Grades.
+insights_logic reads the summaries of archived semesters in place of the
+grades.
+
+An archived semester is rehydrated (its grades put back with their old ids)
+before anything changes in it: editing or deleting the semester, or adding
+or moving a grade into its range (see rehydrate_dates). Exports read the
+archived grades without writing them back (grade_values).
+"""
+import datetime
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+
+from grades import aggregates, dashcache, models, routers
+
+# Days after the end of a semester before it gets archived
+ARCHIVE_AFTER = 2 * 365
+
+
+def _pack(rows):
+    return zlib.compress(json.dumps(rows, separators=(',', ':'))
+                         .encode('utf-8'))
+
+def _unpack(data):
+    rows = json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+    for id, subject_id, date, score, weight, note in rows:
+        yield (id, subject_id,
+               datetime.datetime.strptime(date, '%Y-%m-%d').date(), score,
+               weight, note)
+
+def _semester_grades(semester):
+    return models.Grades.objects.filter(
+        subject__account_id=semester.account_id,
+        date__gte=semester.semester_start, date__lte=semester.semester_end)
+
+@routers.writes
+def archive_semester(semester):
+    with transaction.atomic():
+        semester = models.Semesters.objects.select_for_update()\
+            .get(id=semester.id)
+        if semester.archived:
+            return semester
+        grades = _semester_grades(semester)
+        models.SemesterSummary.objects.bulk_create([
+            models.SemesterSummary(
+                subject_id=row["subject_id"], semester=semester,
+                weighted_sum=row["weighted_sum"], weight_sum=row["weight_sum"],
+                max_score=row["max_score"], count=row["count"])
+            for row in aggregates.grade_stats(grades)])
+        rows = [[id, subject_id, date.isoformat(), score, weight, note]
+                for id, subject_id, date, score, weight, note in grades
+                .order_by('id').values_list('id', 'subject_id', 'date',
+                                            'score', 'weight', 'note')]
+        models.GradeArchive.objects.create(semester=semester,
+                                           data=_pack(rows), count=len(rows))
+        grades.delete()
+        models.SubjectAggregate.objects.filter(semester=semester).delete()
+        semester.archived = True
+        semester.save(update_fields=['archived'])
+    dashcache.bump(semester.account_id)
+    return semester
+
+@routers.writes
+def archive_finished(account_id=None, before=None):
+    """ Archive the semesters that ended before `before` (default:
+    GRADES_ARCHIVE_AFTER days ago). Returns the number archived """
+    if before is None:
+        before = datetime.date.today() - datetime.timedelta(
+            days=getattr(settings, 'GRADES_ARCHIVE_AFTER', ARCHIVE_AFTER))
+    semesters = models.Semesters.objects.filter(archived=False,
+                                                semester_end__lt=before)
+    if account_id is not None:
+        semesters = semesters.filter(account_id=account_id)
+    archived = 0
+    for semester in semesters.iterator():
+        archive_semester(semester)
+        archived += 1
+    return archived
+
+@routers.writes
+def rehydrate(semester):
+    """ Move the archived grades of the semester back into Grades """
+    with transaction.atomic():
+        semester = models.Semesters.objects.select_for_update()\
+            .get(id=semester.id)
+        if not semester.archived:
+            return semester
+        archive = models.GradeArchive.objects.filter(semester=semester)\
+            .first()
+        if archive is not None:
+            rows = list(_unpack(archive.data))
+            # Grades of subjects deleted since the archival are gone
+            subjects = set(models.Subject.objects.filter(
+                id__in=set(row[1] for row in rows))
+                .values_list('id', flat=True))
+            models.Grades.objects.bulk_create([
+                models.Grades(id=id, subject_id=subject_id, date=date,
+                              score=score, weight=weight, note=note)
+                for id, subject_id, date, score, weight, note in rows
+                if subject_id in subjects])
+            archive.delete()
+        models.SemesterSummary.objects.filter(semester=semester).delete()
+        semester.archived = False
+        semester.save(update_fields=['archived'])
+        aggregates.rebuild_semester(semester)
+    dashcache.bump(semester.account_id)
+    return semester
+
+@routers.writes
+def rehydrate_dates(account_id, dates):
+    """ Rehydrate the archived semesters of the account containing any of
+    the dates, before grades are written into them """
+    dates = [date.date() if isinstance(date, datetime.datetime) else date
+             for date in dates if date is not None]
+    if not dates:
+        return
+    for semester in models.Semesters.objects.filter(
+            account_id=account_id, archived=True,
+            semester_start__lte=max(dates), semester_end__gte=min(dates)):
+        if any(semester.semester_start <= date <= semester.semester_end
+               for date in dates):
+            rehydrate(semester)
+
+def grade_values(account_id):
+    """ (id, subject_id, date, score, weight, note) of the archived grades
+    of the account ordered by date and id, without writing them back. Holds
+    one semester in memory at a time """
+    for archive in models.GradeArchive.objects.filter(
+            semester__account_id=account_id)\
+            .order_by('semester__semester_start').iterator():
+        # Semesters don't overlap, sorting within each one is enough
+        for row in sorted(_unpack(archive.data),
+                          key=lambda row: (row[2], row[0])):
+            yield row
@@ -0,0 +1,157 @@
+""" Async counterparts of dashboard_logic and insights_logic
+
+The ORM of this django version is synchronous, so the independent queries
+of a page are started together on a thread pool (every worker thread uses
+its own database connection) and awaited with asyncio.gather. The event
+loop isn't blocked and a page waits about as long as its slowest query
+instead of the sum of all of them. The results are the same structures as
+back.dashboard_logic and back.insights_logic return, and they share the
+dashboard cache.
+
+A page runs up to QUERIES_PER_PAGE queries at once, so the pool has
+GRADES_ASYNC_PAGES (the pages expected to load at the same time in a
+process, default DEFAULT_PAGES) times that many workers, or exactly
+GRADES_ASYNC_WORKERS if set. Pages beyond that wait for free workers and
+get slower, but never fail. Every worker can hold a database connection,
+so the workers of all processes must fit the connection limit of the
+database.
+"""
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Subquery
+
+from grades import aggregates, back, dashcache, models
+
+# Most queries a page starts together (insights without aggregates)
+QUERIES_PER_PAGE = 5
+DEFAULT_PAGES = 2
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _workers():
+    workers = getattr(settings, 'GRADES_ASYNC_WORKERS', None)
+    if workers is None:
+        workers = QUERIES_PER_PAGE * getattr(settings, 'GRADES_ASYNC_PAGES',
+                                             DEFAULT_PAGES)
+    return workers
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers())
+    return _executor
+
+def _run(function, *args):
+    # Same connection handling as a request (respects CONN_MAX_AGE)
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+def _query(function, *args):
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(_get_executor(), _run, function, *args)
+
+
+def _load_context(user_id):
+    context = back.get_account_context(user_id)
+    context.resolver  # build the grading system tables in the worker too
+    return context
+
+def _current_semesters(account_id):
+    now = datetime.datetime.now()
+    return models.Semesters.objects.filter(semester_start__lte=now,
+                                           semester_end__gte=now,
+                                           account_id=account_id)\
+        .order_by('id')
+
+def _current_semester(account_id):
+    return _current_semesters(account_id).first()
+
+def _current_subject_stats(account_id):
+    # Reads the current semester's range in a subquery, so it doesn't have
+    # to wait for the semester query
+    current = _current_semesters(account_id)
+    if aggregates.reads_enabled():
+        rows = models.SubjectAggregate.objects.filter(
+            semester=Subquery(current.values('id')[:1]), count__gt=0)\
+            .order_by('subject_id')\
+            .values_list(*back.AGGREGATE_CELL_COLUMNS)
+    else:
+        rows = back.get_subject_stats_between(
+            account_id, Subquery(current.values('semester_start')[:1]),
+            Subquery(current.values('semester_end')[:1]))
+    return list(rows)
+
+def _list(queryset):
+    return list(queryset)
+
+
+async def dashboard_logic(user_id):
+    account_id = back.get_account_id(user_id)
+    key, result = await _query(dashcache.get, 'dashboard', account_id)
+    if result is not None:
+        return result
+    context, semester, stats = await asyncio.gather(
+        _query(_load_context, user_id),
+        _query(_current_semester, account_id),
+        _query(_current_subject_stats, account_id))
+    subjects = [back.make_subject_stats(context, *row) for row in stats]
+    result = back.build_dashboard(context, semester, subjects)
+    await _query(dashcache.put, key, result)
+    return result
+
+async def insights_logic(user_id):
+    account_id = back.get_account_id(user_id)
+    key, result = await _query(dashcache.get, 'insights', account_id)
+    if result is not None:
+        return result
+    semesters = models.Semesters.objects.filter(account_id=account_id)
+    # Started with the others, it's only used if a semester is archived
+    summaries = models.SemesterSummary.objects.filter(
+        semester__account_id=account_id).order_by('subject_id')\
+        .values_list('semester_id', 'subject_id', 'subject__name',
+                     'subject__weight', 'weighted_sum', 'weight_sum',
+                     'max_score', 'count')
+    summaries = asyncio.ensure_future(_query(_list, summaries))
+    if aggregates.reads_enabled():
+        cells = models.SubjectAggregate.objects.filter(
+            semester__account_id=account_id, count__gt=0)\
+            .order_by('subject_id')\
+            .values_list('semester_id', *back.AGGREGATE_CELL_COLUMNS)
+        context, semesters, cells = await asyncio.gather(
+            _query(_load_context, user_id), _query(_list, semesters),
+            _query(_list, cells))
+        result = await _query(back.build_insights_from_aggregates, context,
+                              semesters, cells)
+    else:
+        subjects = models.Subject.objects.filter(account_id=account_id)\
+            .order_by('id').values_list('id', 'name', 'weight')
+        grades = models.Grades.objects.filter(subject__account_id=account_id)\
+            .values_list('subject_id', 'date', 'score', 'weight')
+        context, semesters, subjects, grades = await asyncio.gather(
+            _query(_load_context, user_id), _query(_list, semesters),
+            _query(_list, subjects), _query(_list, grades))
+        # Bucketing long histories is CPU work, keep it off the loop
+        result = await _query(back.build_insights, context, semesters,
+                              subjects, grades)
+    summaries = await summaries
+    if any(semester.archived for semester in semesters):
+        result = back.add_archived_insights(context, semesters, result,
+                                            summaries)
+    await _query(dashcache.put, key, result)
+    return result
+
+async def is_premium(user_id):
+    """ Premium status, to be gathered together with the page data """
+    context = await _query(back.get_account_context, user_id)
+    return await _query(back.is_premium, context.user, context.account)
@@ -2,15 +2,17 @@ from django.http import HttpResponse
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from django.core.mail import send_mail
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, FloatField, Max, Sum
+from django.utils.functional import cached_property
 
-from grades import models
-from djstripe.utils import subscriber_has_active_subscription
-from email_confirm_la.models import EmailConfirmation
+from grades import (aggregates, archive, dashcache, models, premium,
+                    provisioning, refcache, resolvers, routers)
 
+import bisect
 import datetime
-from collections import namedtuple
 
+@routers.writes
 def _register(request):
     name = request.POST["name"]
     email = request.POST["email"]
@@ -21,144 +23,251 @@ def _register(request):
 
     if password == password2 and len(password) >= 8:
         try:
-            user = User.objects.create_user(email, email, password)
+            result = provisioning.provision_accounts(
+                [(name, email, password)], grading_system)
         except IntegrityError:
             return None
-        EmailConfirmation.objects.verify_email_for_object(email, user)
-        user.is_active = False
-        user.first_name = name
-        user.save()
-        now = datetime.datetime.now()
-        valid = models.AccountValid.objects.get(id=1)
-        grading_sys = models.GradingSystem.objects.get(id=grading_system)
-        account_type = models.AccountType.objects.get(id=1)
-        account = models.Accounts(user=user, create_date=now, valid=valid,
-                grading_sys=grading_sys, account_type=account_type)
-        account.save()
-
-        return user
+        if not result.created:
+            return None
+        return result.created[0]
 
+@routers.writes
 def confirm_email(email):
     user = User.objects.get(email=email)
     user.is_active = True
     user.save()
 
 def is_premium(user, account):
-    if account.sponsored:
-        return True
-    else:
-        return subscriber_has_active_subscription(user)
+    return premium.is_premium(user, account)
+
+class AccountContext(object):
+    """ Account data of a user, loaded once and passed through the helpers
+    of a request instead of re-fetching user and account in every call
+
+    ** Contents **
+    account - Accounts instance with user, grading_sys and css_style loaded
+    resolver - compiled GradeResolver of the grading system
+    calculative - Calculative of the grading system
+    representations - Representative rows of the grading system
+    calculative_descrips - CalculativeDescrip rows of the grading system
+    """
+    def __init__(self, account):
+        self.account = account
+        self.user = account.user
+        self.user_id = account.user_id
+        self.grading_sys = account.grading_sys
+        self.css_style = account.css_style
+
+    @cached_property
+    def resolver(self):
+        return resolvers.get_resolver(self.grading_sys)
+
+    @property
+    def calculative(self):
+        if self.resolver.calculative is None:
+            raise models.Calculative.DoesNotExist
+        return self.resolver.calculative
+
+    @property
+    def representations(self):
+        return self.resolver.representations
+
+    @property
+    def calculative_descrips(self):
+        return self.resolver.descrips
+
+@routers.reads
+def get_account_context(user_id):
+    # Accept an already loaded context so helpers can pass it through
+    if isinstance(user_id, AccountContext):
+        return user_id
+    account = models.Accounts.objects\
+        .select_related('user', 'grading_sys', 'css_style')\
+        .get(user_id=user_id)
+    return AccountContext(account)
+
+@routers.reads
+def get_request_context(request):
+    # Memoize the context on the request for the duration of the request
+    user_id = request.session['member_id']
+    context = getattr(request, '_account_context', None)
+    if context is None or context.user_id != int(user_id):
+        context = get_account_context(user_id)
+        request._account_context = context
+    return context
 
+@routers.reads
 def get_user(user_id):
+    if isinstance(user_id, AccountContext):
+        return user_id.user
     user = User.objects.get(id=user_id)
     return user
 
+@routers.reads
 def get_account(user_id):
-    user = User.objects.get(id=user_id)
-    account = models.Accounts.objects.get(user=user)
-    return account
+    return get_account_context(user_id).account
 
 def get_stylesheets():
-    stylesheets = models.Stylesheet.objects.all()
+    stylesheets = refcache.get('stylesheets')
     return stylesheets
 
 def get_grading_systems():
-    grading_systems = models.GradingSystem.objects.all().order_by('name')
+    grading_systems = refcache.get('grading_systems')
     return grading_systems
 
 def get_countries():
-    countries = models.Country.objects.all().order_by('name')
+    countries = refcache.get('countries')
     return countries
 
 def get_account_types():
-    account_types = models.AccountType.objects.all()
+    account_types = refcache.get('account_types')
     return account_types
 
+def get_legends():
+    legends = refcache.get('legends')
+    return legends
+
+def get_areas():
+    areas = refcache.get('areas')
+    return areas
+
+@routers.reads
 def get_semesters(user_id):
-    account = get_account(user_id)
-    semesters = models.Semesters.objects.all().filter(account=account)
+    context = get_account_context(user_id)
+    semesters = models.Semesters.objects.all()\
+        .filter(account_id=context.user_id)
     return semesters
 
+@routers.reads
 def get_subjects(user_id):
-    account = get_account(user_id)
-    subjects = models.Subject.objects.all().filter(account=account)
+    context = get_account_context(user_id)
+    subjects = models.Subject.objects.all().filter(account_id=context.user_id)
     return subjects
 
+@routers.reads
 def get_grades(user_id):
-    account = get_account(user_id)
-    grades = models.Grades.objects.all().filter(subject__account=account)\
-        .order_by('date')
+    context = get_account_context(user_id)
+    grades = models.Grades.objects.all()\
+        .filter(subject__account_id=context.user_id).order_by('date')
     return grades
 
+@routers.reads
 def get_grades_date_desc(user_id):
-    account = get_account(user_id)
-    grades = models.Grades.objects.all().filter(subject__account=account)\
-        .order_by('-date')
+    context = get_account_context(user_id)
+    grades = models.Grades.objects.all()\
+        .filter(subject__account_id=context.user_id).order_by('-date')
     return grades
 
+@routers.reads
 def get_representations(user_id):
-    account = get_account(user_id)
+    context = get_account_context(user_id)
     representations = models.Representative.objects.all()\
-        .filter(g=account.grading_sys)
+        .filter(g=context.grading_sys)
     return representations
 
+@routers.reads
 def get_calculative(user_id):
-    account = get_account(user_id)
-    calculative = models.Calculative.objects.get(g=account.grading_sys)
-    return calculative
+    context = get_account_context(user_id)
+    return context.calculative
 
+@routers.reads
 def get_semester_now(user_id):
-    account = get_account(user_id)
+    context = get_account_context(user_id)
     now = datetime.datetime.now()
     semester = models.Semesters.objects.filter(semester_start__lte=now,
                                                semester_end__gte=now,
-                                               account=account)
+                                               account_id=context.user_id)
     return semester
 
+class SubjectStats(object):
+    """ Grade statistics of a subject within a semester, as shown on the
+    dashboards
+
+    ** Contents **
+    id, name, weight - of the subject
+    average - resolved average ({"representation", "legend"} for
+              calculative systems, Representative for representative ones)
+    top_grade - resolved top grade (same types as average)
+    score - weighted average in percent (truncated to int)
+    nr_grades - number of grades
+    """
+    __slots__ = ('id', 'name', 'weight', 'average', 'top_grade', 'score',
+                 'nr_grades')
+
+    def __init__(self, id, name, weight, average, top_grade, score,
+                 nr_grades):
+        self.id = id
+        self.name = name
+        self.weight = weight
+        self.average = average
+        self.top_grade = top_grade
+        self.score = score
+        self.nr_grades = nr_grades
+
+    def __str__(self):
+        return self.name
+
+# Columns of the rows make_subject_stats is called with
+SUBJECT_STATS_COLUMNS = ('id', 'name', 'weight', 'weighted_sum', 'weight_sum',
+                         'top_score', 'grade_count')
+AGGREGATE_CELL_COLUMNS = ('subject_id', 'subject__name', 'subject__weight',
+                          'weighted_sum', 'weight_sum', 'max_score', 'count')
+
+@routers.reads
 def get_subjects_for_semester(user_id, semester):
-    account = get_account(user_id)
-    subjects = get_subjects(user_id)
-    subjects_list = []
+    context = get_account_context(user_id)
+    if aggregates.reads_enabled():
+        rows = models.SubjectAggregate.objects.filter(
+            semester=semester, semester__account_id=context.user_id,
+            count__gt=0).order_by('subject_id')\
+            .values_list(*AGGREGATE_CELL_COLUMNS)
+    else:
+        rows = get_semester_subject_stats(context, semester)
+    return [make_subject_stats(context, *row) for row in rows]
+
+@routers.reads
+def get_semester_subject_stats(user_id, semester):
+    context = get_account_context(user_id)
+    return get_subject_stats_between(context.user_id, semester.semester_start,
+                                     semester.semester_end)
+
+@routers.reads
+def get_subject_stats_between(account_id, start, end):
+    # One grouped query for all subjects. The date filter on the grades join
+    # limits the aggregates to the range and drops subjects without grades
+    subjects = models.Subject.objects.filter(
+        account_id=account_id, grades__date__gte=start,
+        grades__date__lte=end)\
+        .annotate(weighted_sum=Sum(F('grades__score') * F('grades__weight'),
+                                   output_field=FloatField()),
+                  weight_sum=Sum('grades__weight'),
+                  top_score=Max('grades__score'),
+                  grade_count=Count('grades'))\
+        .order_by('id').values_list(*SUBJECT_STATS_COLUMNS)
+    return subjects
 
-    for subject in subjects:
-        grades = models.Grades.objects.filter(
-            date__gte=semester.semester_start, date__lte=semester.semester_end,
-            subject=subject)
-        if len(grades) > 0:
-            average = 0;
-            top_grade = 0;
-            counter = 0;
-            for grade in grades:
-                average += (grade.score * grade.weight)
-                counter += grade.weight
-                if grade.score > top_grade:
-                    top_grade = grade.score
-            average = int(average / counter) if average != 0 else 0
-
-            if account.grading_sys.type == 'c':
-                grading_system = models.CalculativeDescrip.objects.all()\
-                    .filter(c__g=account.grading_sys)
-                representation = get_calculative_descrip(grading_system,
-                                                         average)
-                grade = resolve_grade_c(user_id, average)
-                top_grade = resolve_grade_c(user_id, top_grade)
-                output = {"representation": grade,
-                          "legend": representation.legend}
-                output2 = {"representation": top_grade}
-            elif account.grading_sys.type == 'r':
-                grading_system = models.Representative.objects.all()\
-                    .filter(g=account.grading_sys)
-                output = resolve_grade_r(grading_system, average)
-                output2 = resolve_grade_r(grading_system, top_grade)
-            subject.average = output
-            subject.top_grade = output2
-            subject.score = average
-            subject.nr_grades = len(grades)
-            subjects_list.append(subject)
-    return subjects_list
+def make_subject_stats(user_id, subject_id, name, weight, weighted_sum,
+                       weight_sum, top_score, count):
+    context = get_account_context(user_id)
+    account = context.account
+    average = int(weighted_sum / weight_sum) if weighted_sum != 0 else 0
+    top_grade = max(top_score, 0)
+
+    if account.grading_sys.type == 'c':
+        representation = context.resolver.descrip(average)
+        grade = resolve_grade_c(context, average)
+        top_grade = resolve_grade_c(context, top_grade)
+        output = {"representation": grade, "legend": representation.legend}
+        output2 = {"representation": top_grade}
+    elif account.grading_sys.type == 'r':
+        output = context.resolver.representation(average)
+        output2 = context.resolver.representation(top_grade)
+    return SubjectStats(subject_id, name, weight, output, output2, average,
+                        count)
 
 def get_subjects_average(user_id, subjects):
-    account = get_account(user_id)
+    context = get_account_context(user_id)
+    account = context.account
     total_average = 0
     counter = 0
     for subject in subjects:
@@ -169,68 +278,206 @@ def get_subjects_average(user_id, subjects):
     except ZeroDivisionError:
         total_average = 0
     if account.grading_sys.type == 'c':
-        grading_system = models.CalculativeDescrip.objects.all().\
-            filter(c__g=account.grading_sys)
-        representation = get_calculative_descrip(grading_system, total_average)
-        grade = resolve_grade_c(user_id, total_average)
+        representation = context.resolver.descrip(total_average)
+        grade = resolve_grade_c(context, total_average)
         total_avg = {"representation": grade, "legend": representation.legend}
     elif account.grading_sys.type == 'r':
-        grading_system = models.Representative.objects.all()\
-            .filter(g=account.grading_sys)
-        total_avg = resolve_grade_r(grading_system, total_average)
+        total_avg = context.resolver.representation(total_average)
     return total_avg
 
 
+def get_account_id(user_id):
+    """ Account id of a user id or AccountContext """
+    if isinstance(user_id, AccountContext):
+        return user_id.user_id
+    return int(user_id)
+
+@routers.reads
 def dashboard_logic(user_id):
-    semester = get_semester_now(user_id)
+    return dashcache.cached('dashboard', get_account_id(user_id),
+                            lambda: _dashboard_logic(user_id))
+
+def _dashboard_logic(user_id):
+    context = get_account_context(user_id)
+    semester = get_semester_now(context)
     try:
         semester = semester[0]
-        subjects = get_subjects_for_semester(user_id, semester)
-        if len(subjects) == 0:
-            output = {"no_data":True}
-            return output
-
-        now = datetime.datetime.now().date()
-        # Get total average across all subjects
-        total_avg = get_subjects_average(user_id, subjects)
-        
-        # semester progress in % * 100
-        progress = int((semester.semester_start - now) / 
-                       (semester.semester_start - semester.semester_end)*100)
-        output = {"semester": semester, "progress": progress,
-                  "subjects": subjects, "total_avg":total_avg}
     except IndexError:
         # If theres no data for user show different content in html (jinja)
+        return {"no_data":True}
+    subjects = get_subjects_for_semester(context, semester)
+    return build_dashboard(context, semester, subjects)
+
+def build_dashboard(user_id, semester, subjects):
+    context = get_account_context(user_id)
+    if semester is None or len(subjects) == 0:
         output = {"no_data":True}
+        return output
+
+    now = datetime.datetime.now().date()
+    # Get total average across all subjects
+    total_avg = get_subjects_average(context, subjects)
+
+    # semester progress in % * 100
+    progress = int((semester.semester_start - now) / 
+                   (semester.semester_start - semester.semester_end)*100)
+    output = {"semester": semester, "progress": progress,
+              "subjects": subjects, "total_avg":total_avg}
     return output
 
+class SemesterIndex(object):
+    """ Sorted interval index over the semesters of an account, used to
+    assign dates to semesters with a binary search
+
+    ** Contents **
+    semesters - semesters sorted by semester_start
+    starts - semester_start of each semester, same order
+    max_ends - running maximum of semester_end, same order
+    """
+    def __init__(self, semesters):
+        self.semesters = sorted(semesters, key=lambda s: s.semester_start)
+        self.starts = [s.semester_start for s in self.semesters]
+        self.max_ends = []
+        for semester in self.semesters:
+            if self.max_ends and self.max_ends[-1] > semester.semester_end:
+                self.max_ends.append(self.max_ends[-1])
+            else:
+                self.max_ends.append(semester.semester_end)
+
+    def find(self, date):
+        # Semesters shouldn't overlap, but walk back over any that still do
+        found = []
+        i = bisect.bisect_right(self.starts, date) - 1
+        while i >= 0 and self.max_ends[i] >= date:
+            if self.semesters[i].semester_end >= date:
+                found.append(self.semesters[i])
+            i -= 1
+        return found
+
+@routers.reads
 def insights_logic(user_id):
-    semesters = get_semesters(user_id)
+    return dashcache.cached('insights', get_account_id(user_id),
+                            lambda: _insights_logic(user_id))
+
+def _insights_logic(user_id):
+    context = get_account_context(user_id)
+    semesters = list(get_semesters(context))
+    if aggregates.reads_enabled():
+        cells = get_aggregate_cells(context)
+        output = build_insights_from_aggregates(context, semesters, cells)
+    else:
+        subjects = list(get_subjects(context).order_by('id')
+                        .values_list('id', 'name', 'weight'))
+        grades = get_grade_values(context)
+        output = build_insights(context, semesters, subjects, grades)
+    if any(semester.archived for semester in semesters):
+        output = add_archived_insights(context, semesters, output,
+                                       get_semester_summaries(context))
+    return output
+
+@routers.reads
+def get_grade_values(user_id):
+    context = get_account_context(user_id)
+    grades = models.Grades.objects.filter(subject__account_id=context.user_id)\
+        .values_list('subject_id', 'date', 'score', 'weight')
+    return grades
+
+def build_insights(user_id, semesters, subjects, grades):
+    context = get_account_context(user_id)
+    # Bucket every grade into its semester(s) in one pass
+    index = SemesterIndex(semesters)
+    stats = {}
+    for subject_id, date, score, weight in grades:
+        for semester in index.find(date):
+            key = (semester.id, subject_id)
+            stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = [0, 0, 0, 0]
+            stat[0] += score * weight
+            stat[1] += weight
+            if score > stat[2]:
+                stat[2] = score
+            stat[3] += 1
+
+    output = []
+    for semester in semesters:
+        semester_subjects = []
+        for subject_id, name, weight in subjects:
+            stat = stats.get((semester.id, subject_id))
+            if stat is not None:
+                semester_subjects.append(make_subject_stats(
+                    context, subject_id, name, weight, *stat))
+        total_avg = get_subjects_average(context, semester_subjects)
+        output.append({"semester": semester, "subjects": semester_subjects,
+                       "total_avg":total_avg})
+    return output
+
+@routers.reads
+def get_aggregate_cells(user_id):
+    context = get_account_context(user_id)
+    cells = models.SubjectAggregate.objects.filter(
+        semester__account_id=context.user_id, count__gt=0)\
+        .order_by('subject_id')\
+        .values_list('semester_id', *AGGREGATE_CELL_COLUMNS)
+    return cells
+
+@routers.reads
+def get_semester_summaries(user_id):
+    context = get_account_context(user_id)
+    summaries = models.SemesterSummary.objects.filter(
+        semester__account_id=context.user_id)\
+        .order_by('subject_id')\
+        .values_list('semester_id', 'subject_id', 'subject__name',
+                     'subject__weight', 'weighted_sum', 'weight_sum',
+                     'max_score', 'count')
+    return summaries
+
+def add_archived_insights(user_id, semesters, output, summaries):
+    """ Replace the (empty) insights of archived semesters with the ones of
+    their summaries """
+    context = get_account_context(user_id)
+    archived = [semester for semester in semesters if semester.archived]
+    by_id = dict((item["semester"].id, item) for item in output)
+    for item in build_insights_from_aggregates(context, archived, summaries):
+        by_id[item["semester"].id] = item
+    return [by_id[semester.id] for semester in semesters]
+
+def build_insights_from_aggregates(user_id, semesters, cells):
+    context = get_account_context(user_id)
+    by_semester = {}
+    for cell in cells:
+        by_semester.setdefault(cell[0], []).append(
+            make_subject_stats(context, *cell[1:]))
     output = []
     for semester in semesters:
-        subjects = get_subjects_for_semester(user_id, semester)
-        total_avg = get_subjects_average(user_id, subjects)
+        subjects = by_semester.get(semester.id, [])
+        total_avg = get_subjects_average(context, subjects)
         output.append({"semester": semester, "subjects": subjects,
                        "total_avg":total_avg})
     return output
 
+@routers.writes
 def new_semester(request):
     start_date = request.POST["start"]
     end_date = request.POST["end"]
     name = request.POST["name"]
     start_date = datetime.datetime.strptime(start_date, '%m/%d/%Y').date()
     end_date = datetime.datetime.strptime(end_date, '%m/%d/%Y').date()
-    user_id = request.session['member_id']
-    account = get_account(user_id)
-    semester_valid = check_semester(user_id, start_date, end_date, 0)
+    context = get_request_context(request)
+    account = context.account
+    semester_valid = check_semester(context, start_date, end_date, 0)
     if semester_valid:
         semester = models.Semesters(name=name, semester_start=start_date,
                                     semester_end=end_date, account=account)
-        semester.save()
+        with transaction.atomic():
+            semester.save()
+            aggregates.rebuild_semester(semester)
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def edit_semester(request):
     id = request.POST["id"]
     name = request.POST["name"]
@@ -238,72 +485,93 @@ def edit_semester(request):
     end = request.POST["end"]
     start_date = datetime.datetime.strptime(start, '%m/%d/%Y').date()
     end_date = datetime.datetime.strptime(end, '%m/%d/%Y').date()
-    user_id = request.session['member_id']
-    semester_valid = check_semester(user_id, start_date, end_date, id)
-    semester_owned = check_semester_ownership(user_id, id)
+    context = get_request_context(request)
+    semester_valid = check_semester(context, start_date, end_date, id)
+    semester_owned = check_semester_ownership(context, id)
     if semester_valid and semester_owned:
         semester = models.Semesters.objects.get(id=id)
+        if semester.archived:
+            semester = archive.rehydrate(semester)
         semester.name = name
-        semester.semester_start = datetime.datetime.strptime(start, '%m/%d/%Y')
-        semester.semester_end = datetime.datetime.strptime(end , '%m/%d/%Y')
-        semester.save()
+        semester.semester_start = start_date
+        semester.semester_end = end_date
+        with transaction.atomic():
+            semester.save()
+            aggregates.rebuild_semester(semester)
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def del_semester(request):
     semester_id = request.POST["id"]
-    semester_owned = check_semester_ownership(request.session['member_id'],
-                                              semester_id)
+    context = get_request_context(request)
+    semester_owned = check_semester_ownership(context, semester_id)
     if semester_owned:
         semester = models.Semesters.objects.get(id=semester_id)
+        if semester.archived:
+            # The grades outlive the semester, as for live semesters
+            archive.rehydrate(semester)
         semester.delete()
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def new_subject(request, user_id):
     name = request.POST["name"]
     weight = request.POST["weight"]
-    account = get_account(request.session['member_id'])
+    context = get_request_context(request)
+    account = context.account
     all_subjects = models.Subject.objects.all().filter(account=account)
-    user = get_user(user_id)
+    user = context.user if context.user_id == get_account_id(user_id) \
+        else get_user(user_id)
     premium = is_premium(user, account)
     if len(all_subjects)>= 10 and premium == False:
         return "subjectlimit"
     else:
         subject = models.Subject(name=name, weight=weight, account=account)
         subject.save()
+        dashcache.bump(context.user_id)
         return subject
     return None
 
+@routers.writes
 def edit_subject(request):
     id = request.POST["id"]
     name = request.POST["name"]
     weight = request.POST["weight"]
-    subject_owned = check_subject_ownership(request.session['member_id'], id)
+    context = get_request_context(request)
+    subject_owned = check_subject_ownership(context, id)
     if subject_owned:
         subject = models.Subject.objects.get(id=id)
         subject.name = name
         subject.weight = weight
         subject.save()
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def del_subject(request):
     subject_id = request.POST["id"]
-    subject_owned = check_subject_ownership(request.session['member_id'],
-                                            subject_id)
+    context = get_request_context(request)
+    subject_owned = check_subject_ownership(context, subject_id)
     if subject_owned:
         subject = models.Subject.objects.get(id=subject_id)
         subject.delete()
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def new_grade(request):
-    account = get_account(request.session['member_id'])
+    context = get_request_context(request)
+    account = context.account
     grade = request.POST["grade"]
     total_points = request.POST["total_pts"]
     earned_points = request.POST["pts"]
@@ -314,21 +582,18 @@ def new_grade(request):
     date = request.POST["date"]
     date = datetime.datetime.strptime(date, '%m/%d/%Y')
     note = request.POST["note"]
-    subject_owned = check_subject_ownership(request.session['member_id'],
-                                            subject_id)
+    subject_owned = check_subject_ownership(context, subject_id)
     try:
         if subject_owned:
             if account.grading_sys.type == "c":
                 #calculational
-                grading_system = models.Calculative.objects\
-                    .get(g=account.grading_sys)
+                grading_system = context.calculative
                 score = resolve_grade_percent_c(grading_system, grade,
                                                 total_points, earned_points,
                                                 grade_percent)
             elif account.grading_sys.type == "r":
                 #representative
-                grading_system = models.Representative.objects.all()\
-                    .filter(g=account.grading_sys)
+                grading_system = context.resolver
                 score = resolve_grade_percent_r(grading_system, grade,
                                                 total_points, earned_points,
                                                 grade_percent)
@@ -336,15 +601,22 @@ def new_grade(request):
                 return None
             grade = models.Grades(subject=subject, note=note, date=date,
                                   weight=weight, score=score)
-            grade.save()
+            archive.rehydrate_dates(context.user_id, [date])
+            with transaction.atomic():
+                grade.save()
+                aggregates.grade_added(account.user_id, subject.id, date,
+                                       score, weight)
+            dashcache.bump(context.user_id)
             return grade
         else:
             return None
     except UnboundLocalError:
         return None
 
+@routers.writes
 def edit_grade(request):
-    account = get_account(request.session['member_id'])
+    context = get_request_context(request)
+    account = context.account
     id = request.POST["id"]
     score = request.POST["grade"]
     subject_id = request.POST["subject"]
@@ -353,45 +625,55 @@ def edit_grade(request):
     date = datetime.datetime.strptime(date, '%m/%d/%Y')
     note = request.POST["note"]
     subject = models.Subject.objects.get(id=subject_id)
-    grade_owned = check_grade_ownership(request.session['member_id'], id)
-    subject_owned = check_subject_ownership(request.session['member_id'],
-                                            subject_id)
+    grade_owned = check_grade_ownership(context, id)
+    subject_owned = check_subject_ownership(context, subject_id)
 
     if grade_owned and subject_owned:
         if account.grading_sys.type == "c":
             #calculational
-            grading_system = models.Calculative.objects\
-                .get(g=account.grading_sys)
+            grading_system = context.calculative
             score = resolve_grade_percent_c(grading_system, score, '', '', '')
         elif account.grading_sys.type == "r":
             #representative
-            grading_system = models.Representative.objects.all()\
-                .filter(g=account.grading_sys)
+            grading_system = context.resolver
             score = resolve_grade_percent_r(grading_system, score, '', '', '')
         else:
             return False
 
         grade = models.Grades.objects.get(id=id)
+        old = (grade.subject_id, grade.date, grade.score, grade.weight)
         grade.score = score
         grade.subject = subject
         grade.date = date
         grade.weight = weight
         grade.note = note
-        grade.save()
+        archive.rehydrate_dates(context.user_id, [date])
+        with transaction.atomic():
+            grade.save()
+            aggregates.grade_changed(account.user_id, old,
+                                     (subject.id, date, score, weight))
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def del_grade(request):
     grade_id = request.POST["id"]
-    grade_owned = check_grade_ownership(request.session['member_id'], grade_id)
+    context = get_request_context(request)
+    grade_owned = check_grade_ownership(context, grade_id)
     if grade_owned:
         grade = models.Grades.objects.get(id=grade_id)
-        grade.delete()
+        with transaction.atomic():
+            grade.delete()
+            aggregates.grade_removed(context.user_id, grade.subject_id,
+                                     grade.date, grade.score, grade.weight)
+        dashcache.bump(context.user_id)
         return True
     else:
         return False
 
+@routers.writes
 def update_user_data(user_id, request):
     user = get_user(user_id)
     name = request.POST["name"]
@@ -404,6 +686,7 @@ def update_user_data(user_id, request):
     else:
         return False
 
+@routers.writes
 def change_password(user_id, request):
     user = get_user(user_id)
     password = request.POST["password"]
@@ -423,13 +706,16 @@ def change_password(user_id, request):
     else:
         return False
 
+@routers.writes
 def update_properties(user_id, request):
     success = False
     stylesheet = request.POST["stylesheet"]
     grading_system = request.POST["grading_system"]
     account = get_account(user_id)
-    stylesheet = models.Stylesheet.objects.get(id=stylesheet)
-    grading_system = models.GradingSystem.objects.get(id=grading_system)
+    # The memoized context would keep the old grading system
+    request.__dict__.pop('_account_context', None)
+    stylesheet = refcache.get_by_id('stylesheets', stylesheet)
+    grading_system = refcache.get_by_id('grading_systems', grading_system)
     if stylesheet is not None:
         account.css_style = stylesheet
         account.save()
@@ -438,6 +724,13 @@ def update_properties(user_id, request):
         account.grading_sys = grading_system
         account.save()
         success = True
+    area = request.POST.get("area")
+    if area is not None:
+        # Optional, only used for the cohort comparisons
+        account.area = refcache.get_by_id('areas', area) if area else None
+        account.save()
+        success = True
+    dashcache.bump(account.user_id)
     return success
 
 def resolve_grade_percent_c(grading_system, grade, total_points, earned_points,
@@ -472,7 +765,7 @@ def resolve_grade_percent_c(grading_system, grade, total_points, earned_points,
 def resolve_grade_percent_r(grading_system, grade, total_points, earned_points,
                             grade_percent):
     if grade != '':
-        representative = models.Representative.objects.get(id=grade)
+        representative = get_representative(grading_system, grade)
         score = int((representative.top - representative.bottom)/2)\
             + representative.bottom
     elif total_points != '' and earned_points != '':
@@ -491,23 +784,13 @@ def resolve_grade_percent_r(grading_system, grade, total_points, earned_points,
         # Throw error - no grade given in html form
     return score
 
+def get_representative(grading_system, representative_id):
+    if isinstance(grading_system, resolvers.GradeResolver):
+        return grading_system.representative(representative_id)
+    return models.Representative.objects.get(id=representative_id)
+
 def resolve_grade_c(user_id, grade_per):
-    account = get_account(user_id)
-    grading_system = models.Calculative.objects.get(g=account.grading_sys)
-    grade_range = grading_system.top - grading_system.bottom
-    if grade_per == 0:
-        return grading_system.bottom
-    elif grade_per > grading_system.bottom_per:
-        # calculate difference between 100% and the bottom % and find out how
-        # much of the grade that difference is and add grade bottom
-        upper_diff = 100 - grading_system.bottom_per
-        grade_diff = grade_per - grading_system.bottom_per
-        grade = ((grade_diff / upper_diff) * grade_range)\
-            + grading_system.bottom
-        return round(grade, 2)
-    else:
-        grade = (grade_per / grading_system.bottom_per) * grading_system.bottom
-        return round(grade, 2)
+    return get_account_context(user_id).resolver.grade(grade_per)
 
 def get_calculative_descrip(calculative, grade_per):
     lowest_descrip = None;
@@ -528,50 +811,145 @@ def resolve_grade_r(grading_system, grade_per):
             return sys
 
 def add_representation_to_grades(grading_sys, grades):
-    grading_system = models.Representative.objects.all().filter(g=grading_sys)
+    resolver = resolvers.get_resolver(grading_sys)
     for grade in grades:
-        r = resolve_grade_r(grading_system, grade.score)
+        r = resolver.representation(grade.score)
         grade.calc = r.representation
         grade.calc_id = r.id
     return grades
 
+class GradeRow(object):
+    """ A grade as listed to the user
+
+    ** Contents **
+    id, subject_id, date, weight, score, note - of the grade
+    calc - resolved grade (representation or calculated grade)
+    calc_id - id of the Representative (representative systems)
+    """
+    __slots__ = ('id', 'subject_id', 'date', 'weight', 'score', 'note',
+                 'calc', 'calc_id')
+
+    def __init__(self, id, subject_id, date, weight, score, note):
+        self.id = id
+        self.subject_id = subject_id
+        self.date = date
+        self.weight = weight
+        self.score = score
+        self.note = note
+        self.calc = None
+        self.calc_id = None
+
+@routers.reads
+def get_grade_rows(user_id, descending=False):
+    context = get_account_context(user_id)
+    grades = models.Grades.objects\
+        .filter(subject__account_id=context.user_id)\
+        .order_by('-date' if descending else 'date')\
+        .values_list('id', 'subject_id', 'date', 'weight', 'score', 'note')
+    resolver = context.resolver
+    rows = []
+    for values in grades:
+        row = GradeRow(*values)
+        if context.grading_sys.type == 'r':
+            r = resolver.representation(row.score)
+            row.calc = r.representation
+            row.calc_id = r.id
+        elif context.grading_sys.type == 'c':
+            row.calc = resolver.grade(row.score)
+        rows.append(row)
+    return rows
+
+@routers.reads
 def check_semester(user_id, start, end, id):
-    semesters = get_semesters(user_id)
-    Range = namedtuple('Range', ['start', 'end'])
-    r1 = Range(start=start, end=end)
-    for semester in semesters:
-        if semester.id == int(id):
-            # skip checking a semester against itself
-            # (used when editing a semester)
-            continue
-        r2 = Range(start=semester.semester_start, end=semester.semester_end)
-        latest_start = max(r1.start, r2.start)
-        earliest_end = min(r1.end, r2.end)
-        overlap = (earliest_end - latest_start).days + 1
-        if overlap > 0:
+    context = get_account_context(user_id)
+    # skip checking a semester against itself (used when editing a semester)
+    overlapping = models.Semesters.objects.filter(
+        account_id=context.user_id, semester_start__lte=end,
+        semester_end__gte=start).exclude(id=int(id))
+    return not overlapping.exists()
+
+@routers.reads
+def check_semesters(user_id, ranges):
+    """ Check (start, end) ranges against each other and the account's
+    semesters in one sorted sweep """
+    context = get_account_context(user_id)
+    if not ranges:
+        return True
+    for start, end in ranges:
+        if start > end:
             return False
+    existing = models.Semesters.objects.filter(
+        account_id=context.user_id,
+        semester_start__lte=max(end for _, end in ranges),
+        semester_end__gte=min(start for start, _ in ranges))\
+        .values_list('semester_start', 'semester_end')
+    previous_end = None
+    for start, end in sorted(list(ranges) + list(existing)):
+        if previous_end is not None and start <= previous_end:
+            return False
+        previous_end = end if previous_end is None \
+            else max(previous_end, end)
     return True
 
+@routers.writes
+def new_semesters(user_id, semesters):
+    """ Create several semesters at once from (name, start, end) tuples.
+    Returns the created semesters or False if any of them overlap """
+    context = get_account_context(user_id)
+    if not check_semesters(context, [(start, end)
+                                     for _, start, end in semesters]):
+        return False
+    with transaction.atomic():
+        models.Semesters.objects.bulk_create([
+            models.Semesters(name=name, semester_start=start,
+                             semester_end=end, account_id=context.user_id)
+            for name, start, end in semesters])
+        # bulk_create doesn't return ids on every database
+        created = list(models.Semesters.objects.filter(
+            account_id=context.user_id,
+            semester_start__in=[start for _, start, _ in semesters]))
+        for semester in created:
+            aggregates.rebuild_semester(semester)
+    dashcache.bump(context.user_id)
+    return created
+
+@routers.reads
 def check_semester_ownership(user_id, semester_id):
-    account = get_account(user_id)
-    semesters = models.Semesters.objects.all().filter(account=account)
-    for semester in semesters:
-        if semester.id == int(semester_id):
-            return True
-    return False
+    context = get_account_context(user_id)
+    return models.Semesters.objects.filter(
+        id=int(semester_id), account_id=context.user_id).exists()
 
+@routers.reads
 def check_subject_ownership(user_id, subject_id):
-    account = get_account(user_id)
-    subjects = models.Subject.objects.all().filter(account=account)
-    for subject in subjects:
-        if subject.id == int(subject_id):
-            return True
-    return False
+    context = get_account_context(user_id)
+    return models.Subject.objects.filter(
+        id=int(subject_id), account_id=context.user_id).exists()
 
+@routers.reads
 def check_grade_ownership(user_id, grade_id):
-    account = get_account(user_id)
-    grades = models.Grades.objects.all().filter(subject__account=account)
-    for grade in grades:
-        if grade.id == int(grade_id):
-            return True
-    return False
+    context = get_account_context(user_id)
+    return models.Grades.objects.filter(
+        id=int(grade_id), subject__account_id=context.user_id).exists()
+
+# Batch variants, return the subset of the given ids owned by the account
+
+@routers.reads
+def get_owned_semester_ids(user_id, semester_ids):
+    context = get_account_context(user_id)
+    return set(models.Semesters.objects.filter(
+        id__in=set(int(id) for id in semester_ids),
+        account_id=context.user_id).values_list('id', flat=True))
+
+@routers.reads
+def get_owned_subject_ids(user_id, subject_ids):
+    context = get_account_context(user_id)
+    return set(models.Subject.objects.filter(
+        id__in=set(int(id) for id in subject_ids),
+        account_id=context.user_id).values_list('id', flat=True))
+
+@routers.reads
+def get_owned_grade_ids(user_id, grade_ids):
+    context = get_account_context(user_id)
+    return set(models.Grades.objects.filter(
+        id__in=set(int(id) for id in grade_ids),
+        subject__account_id=context.user_id).values_list('id', flat=True))
@@ -0,0 +1,334 @@
+""" Batch mutations of grades, subjects and semesters
+
+apply(user_id, operations) takes a list of operation dicts
+
+    {"op": "create" | "update" | "delete",
+     "type": "grade" | "subject" | "semester",
+     "id": ...,  # update and delete
+     ...}        # the fields of the matching form
+
+with the field names of the views (grade: subject, date, grade, total_pts,
+pts, percent, weight, note; subject: name, weight; semester: name, start,
+end). An update replaces the whole row, so it must give every field (for
+grades a grade, a percent or both total_pts and pts).
+
+Ownership is checked with one query per type, grades are resolved against
+the account's cached grading system and all valid operations are written in
+one transaction with bulk_create, one UPDATE per type (CASE WHEN on the id)
+and filter().delete(). Invalid operations are skipped and reported, they
+don't stop the others.
+
+Grades can only refer to subjects that exist before the batch. Created
+subjects and grades get their id in the result only on databases that
+return ids from bulk inserts (ex. PostgreSQL), None elsewhere.
+"""
+import datetime
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from grades import (aggregates, archive, back, dashcache, importer, models,
+                    routers)
+
+TYPES = ('grade', 'subject', 'semester')
+OPS = ('create', 'update', 'delete')
+DATE_FORMAT = '%m/%d/%Y'
+# Free accounts can't have more subjects than this, as in new_subject
+SUBJECT_LIMIT = 10
+# Fields an update must give, it replaces the whole row
+UPDATE_FIELDS = {
+    'grade': ('subject', 'date', 'weight', 'note'),
+    'subject': ('name', 'weight'),
+    'semester': ('name', 'start', 'end'),
+}
+
+OperationResult = namedtuple('OperationResult', ['ok', 'id', 'error'])
+
+
+class OperationError(Exception):
+    pass
+
+
+def _id(operation):
+    try:
+        return int(operation.get("id"))
+    except (TypeError, ValueError):
+        raise OperationError("invalid id '{}'".format(operation.get("id")))
+
+def _require(operation):
+    if operation["op"] != 'update':
+        return
+    missing = [name for name in UPDATE_FIELDS[operation["type"]]
+               if name not in operation]
+    if missing:
+        raise OperationError("missing field {}".format(", ".join(missing)))
+
+def _update_by_id(model, rows, fields):
+    """ Write {id: {field: value}} with one UPDATE per model """
+    if not rows:
+        return
+    updates = {}
+    for name in fields:
+        field = model._meta.get_field(name)
+        output_field = field.target_field if field.is_relation else field
+        updates[name] = Case(
+            *[When(id=id, then=Value(values[name], output_field=output_field))
+              for id, values in rows.items()],
+            output_field=output_field)
+    model.objects.filter(id__in=list(rows)).update(**updates)
+
+
+############## Validation ###################
+
+def _validate_semesters(context, operations, results):
+    """ Returns (deletes, updates, creates) of the valid semester
+    operations, updates as {id: fields} """
+    if not operations:
+        return set(), {}, []
+    existing = dict(
+        (id, (start, end)) for id, start, end in models.Semesters.objects
+        .filter(account_id=context.user_id)
+        .values_list('id', 'semester_start', 'semester_end'))
+    deletes = set()
+    updates = {}
+    creates = []
+    final = dict(existing)
+    for i, operation in operations:
+        try:
+            id = None
+            if operation["op"] != 'create':
+                id = _id(operation)
+                if id not in existing:
+                    raise OperationError("unknown semester '{}'".format(id))
+            if operation["op"] == 'delete':
+                deletes.add(id)
+                final.pop(id, None)
+                results[i] = OperationResult(True, id, None)
+                continue
+            _require(operation)
+            start = datetime.datetime.strptime(operation["start"],
+                                               DATE_FORMAT).date()
+            end = datetime.datetime.strptime(operation["end"],
+                                             DATE_FORMAT).date()
+            if start > end:
+                raise OperationError("semester ends before it starts")
+            fields = {"name": operation.get("name"), "semester_start": start,
+                      "semester_end": end}
+            if id is None:
+                creates.append((i, fields))
+                final[('new', i)] = (start, end)
+            else:
+                updates[id] = fields
+                final[id] = (start, end)
+                results[i] = OperationResult(True, id, None)
+        except (OperationError, KeyError, TypeError, ValueError) as e:
+            results[i] = OperationResult(False, None, str(e))
+
+    # The semesters as they will be after the batch must not overlap, as
+    # in new_semesters the changed ones are all rejected if they do
+    previous_end = None
+    for start, end in sorted(final.values()):
+        if previous_end is not None and start <= previous_end:
+            for i, operation in operations:
+                if operation["op"] != 'delete' and results[i] is None or \
+                        operation["op"] == 'update' and results[i].ok:
+                    results[i] = OperationResult(
+                        False, None, "semesters overlap")
+            return deletes, {}, []
+        previous_end = end if previous_end is None \
+            else max(previous_end, end)
+    return deletes, updates, creates
+
+def _referenced_subjects(subject_operations, grade_operations):
+    ids = []
+    for _, operation in subject_operations:
+        if operation["op"] != 'create':
+            try:
+                ids.append(_id(operation))
+            except OperationError:
+                pass
+    for _, operation in grade_operations:
+        if operation["op"] != 'delete':
+            subject_id = importer.row_subject_id(operation)
+            if subject_id is not None:
+                ids.append(subject_id)
+    return ids
+
+def _validate_subjects(context, operations, results, owned):
+    deletes = set()
+    updates = {}
+    creates = []
+    for i, operation in operations:
+        try:
+            id = None
+            if operation["op"] != 'create':
+                id = _id(operation)
+                if id not in owned:
+                    raise OperationError("unknown subject '{}'".format(id))
+            if operation["op"] == 'delete':
+                deletes.add(id)
+                results[i] = OperationResult(True, id, None)
+                continue
+            _require(operation)
+            fields = {"name": operation["name"],
+                      "weight": float(operation.get("weight") or 1)}
+            if id is None:
+                creates.append((i, fields))
+            else:
+                updates[id] = fields
+                results[i] = OperationResult(True, id, None)
+        except (OperationError, KeyError, TypeError, ValueError) as e:
+            results[i] = OperationResult(False, None, str(e))
+
+    if creates:
+        count = models.Subject.objects.filter(
+            account_id=context.user_id).count() - len(deletes)
+        if count + len(creates) > SUBJECT_LIMIT and \
+                not back.is_premium(context.user, context.account):
+            for i, _ in creates[max(SUBJECT_LIMIT - count, 0):]:
+                results[i] = OperationResult(False, None, "subjectlimit")
+            creates = creates[:max(SUBJECT_LIMIT - count, 0)]
+    return deletes, updates, creates
+
+def _validate_grades(context, operations, results, owned_subjects):
+    ids = []
+    for _, operation in operations:
+        if operation["op"] != 'create':
+            try:
+                ids.append(_id(operation))
+            except OperationError:
+                pass
+    # Ownership and the old dates (for the aggregates) in one query
+    old_dates = dict(models.Grades.objects.filter(
+        id__in=ids, subject__account_id=context.user_id)
+        .values_list('id', 'date')) if ids else {}
+    deletes = set()
+    updates = {}
+    creates = []
+    dates = set()
+    for i, operation in operations:
+        try:
+            id = None
+            if operation["op"] != 'create':
+                id = _id(operation)
+                if id not in old_dates:
+                    raise OperationError("unknown grade '{}'".format(id))
+                dates.add(old_dates[id])
+            if operation["op"] == 'delete':
+                deletes.add(id)
+                results[i] = OperationResult(True, id, None)
+                continue
+            _require(operation)
+            grade = importer.build_grade(context, operation, owned_subjects)
+            dates.add(grade.date)
+            if id is None:
+                creates.append((i, grade))
+            else:
+                updates[id] = {"subject": grade.subject_id,
+                               "date": grade.date, "score": grade.score,
+                               "weight": grade.weight, "note": grade.note}
+                results[i] = OperationResult(True, id, None)
+        except (OperationError, importer.RowError, KeyError, TypeError,
+                ValueError, ZeroDivisionError,
+                models.Representative.DoesNotExist) as e:
+            results[i] = OperationResult(False, None, str(e))
+    return deletes, updates, creates, dates
+
+
+############## Apply ###################
+
+def _rebuild(context, dates, semester_ids, semester_starts):
+    semesters = list(models.Semesters.objects.filter(
+        account_id=context.user_id))
+    affected = {}
+    index = back.SemesterIndex(semesters)
+    for date in dates:
+        for semester in index.find(date):
+            affected[semester.id] = semester
+    for semester in semesters:
+        if semester.id in semester_ids or \
+                semester.semester_start in semester_starts:
+            affected[semester.id] = semester
+    for semester in affected.values():
+        aggregates.rebuild_semester(semester)
+    return semesters
+
+@routers.writes
+def apply(user_id, operations):
+    """ Apply a list of operations for the account. Returns an
+    OperationResult(ok, id, error) per operation, in the same order """
+    context = back.get_account_context(user_id)
+    results = [None] * len(operations)
+    by_type = dict((type, []) for type in TYPES)
+    for i, operation in enumerate(operations):
+        if operation.get("type") not in TYPES or \
+                operation.get("op") not in OPS:
+            results[i] = OperationResult(False, None, "unknown operation")
+        else:
+            by_type[operation["type"]].append((i, operation))
+    if context.grading_sys.type not in ('c', 'r'):
+        for i, _ in by_type['grade']:
+            results[i] = OperationResult(
+                False, None, "grading system doesn't support grades")
+        by_type['grade'] = []
+
+    semesters = _validate_semesters(context, by_type['semester'], results)
+    subject_ids = _referenced_subjects(by_type['subject'], by_type['grade'])
+    owned = back.get_owned_subject_ids(context, subject_ids) \
+        if subject_ids else set()
+    subjects = _validate_subjects(context, by_type['subject'], results,
+                                  owned)
+    # Grades of subjects deleted in the batch would be deleted with them
+    grades = _validate_grades(context, by_type['grade'], results,
+                              owned - subjects[0])
+
+    with transaction.atomic():
+        # Archived semesters are put back before anything changes in them
+        archive.rehydrate_dates(context.user_id, grades[3])
+        changed = semesters[0] | set(semesters[1])
+        if changed:
+            for semester in models.Semesters.objects.filter(
+                    id__in=changed, archived=True):
+                archive.rehydrate(semester)
+
+        deletes, updates, creates = semesters
+        if deletes:
+            models.Semesters.objects.filter(id__in=deletes).delete()
+        _update_by_id(models.Semesters, updates,
+                      ('name', 'semester_start', 'semester_end'))
+        models.Semesters.objects.bulk_create([
+            models.Semesters(account_id=context.user_id, **fields)
+            for _, fields in creates])
+
+        deletes, updates, creates = subjects
+        if deletes:
+            models.Subject.objects.filter(id__in=deletes).delete()
+        _update_by_id(models.Subject, updates, ('name', 'weight'))
+        new = [models.Subject(account_id=context.user_id, **fields)
+               for _, fields in creates]
+        models.Subject.objects.bulk_create(new)
+        for (i, _), subject in zip(creates, new):
+            results[i] = OperationResult(True, subject.id, None)
+
+        deletes, updates, creates, dates = grades
+        if deletes:
+            models.Grades.objects.filter(id__in=deletes).delete()
+        _update_by_id(models.Grades, updates,
+                      ('subject', 'date', 'score', 'weight', 'note'))
+        models.Grades.objects.bulk_create([grade for _, grade in creates])
+        for i, grade in creates:
+            results[i] = OperationResult(True, grade.id, None)
+
+        created_starts = set(fields["semester_start"]
+                             for _, fields in semesters[2])
+        all_semesters = []
+        if dates or semesters[1] or created_starts:
+            all_semesters = _rebuild(context, dates, set(semesters[1]),
+                                     created_starts)
+        for i, fields in semesters[2]:
+            id = next(s.id for s in all_semesters
+                      if s.semester_start == fields["semester_start"])
+            results[i] = OperationResult(True, id, None)
+    dashcache.bump(context.user_id)
+    return results
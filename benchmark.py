@@ -0,0 +1,249 @@
+""" Benchmarks for the back.py entry points
+
+Generates a deterministic data set (accounts x semesters x subjects x grades
+per subject and semester, half of the accounts on a calculative and half on
+a representative grading system) in a local SQLite database and reports wall
+time, query count and peak memory of the entry points at several sizes.
+
+    python -m grades.benchmark [database file]
+
+Exits with 1 if the query count of a path that should be constant grows
+with the data size, or if a hot query falls back to a full table scan.
+"""
+import datetime
+import random
+import sys
+import time
+import tracemalloc
+
+SIZES = [
+    # accounts, semesters, subjects, grades per subject and semester
+    (2, 2, 3, 5),
+    (4, 4, 8, 20),
+    (4, 8, 15, 60),
+]
+# Entry points whose query count must not depend on the data size
+CONSTANT = ('dashboard_logic', 'insights_logic', 'new_grade',
+            'add_representation_to_grades', 'get_grade_rows',
+            'check_grade_ownership', 'grade_listing')
+SEED = 1
+
+
+def configure(database=':memory:', replica=False, **options):
+    """ Standalone settings on a SQLite database, also used by the tests.
+    With replica a 'replica' alias (see routers) reads the same database,
+    options are added to the settings """
+    from django.conf import settings
+    if not settings.configured:
+        databases = {"default": {"ENGINE": "django.db.backends.sqlite3",
+                                 "NAME": database}}
+        if replica:
+            databases["replica"] = dict(databases["default"],
+                                        TEST={"MIRROR": "default"})
+        values = dict(
+            DEBUG=False,
+            DATABASES=databases,
+            INSTALLED_APPS=["django.contrib.contenttypes",
+                            "django.contrib.auth",
+                            "django.contrib.sessions",
+                            "email_confirm_la",
+                            "djstripe",
+                            "grades.apps.GradesConfig"],
+            EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            USE_TZ=False,
+        )
+        values.update(options)
+        settings.configure(**values)
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+class Request(object):
+    """ Stand-in for the form requests of the views """
+    def __init__(self, user_id, post):
+        self.POST = post
+        self.session = {"member_id": user_id}
+
+
+############## Data generator ###################
+
+def seed_reference_data():
+    from grades import models
+    legends = [models.Legend.objects.create(description=description, lvl=lvl)
+               for lvl, description in enumerate(
+                   ["Excellent", "Good", "Sufficient", "Bad"], 1)]
+    models.AccountValid.objects.create(id=1, isvalid=True, level=1,
+                                       message="valid")
+    models.AccountType.objects.create(id=1, name="Free", price=0,
+                                      periodicity=12, restrict_lvl=0)
+    models.Stylesheet.objects.create(id=1, name="default.css")
+
+    calculative_sys = models.GradingSystem.objects.create(name="CH",
+                                                          type='c')
+    calculative = models.Calculative.objects.create(
+        bottom=1, top=6, bottom_per=20, g=calculative_sys)
+    for bottom, top, legend in [(0, 50, 3), (50, 70, 2), (70, 90, 1),
+                                (90, 101, 0)]:
+        models.CalculativeDescrip.objects.create(
+            bottom=bottom, top=top, legend=legends[legend], c=calculative)
+
+    representative_sys = models.GradingSystem.objects.create(name="US",
+                                                             type='r')
+    for bottom, top, representation, legend in [
+            (0, 60, "F", 3), (60, 70, "D", 2), (70, 80, "C", 2),
+            (80, 90, "B", 1), (90, 101, "A", 0)]:
+        models.Representative.objects.create(
+            bottom=bottom, top=top, representation=representation,
+            legend=legends[legend], g=representative_sys)
+    return calculative_sys, representative_sys
+
+def generate(accounts, semesters, subjects, grades, seed=SEED):
+    """ Returns the user ids of the generated accounts """
+    from django.contrib.auth.models import User
+    from grades import aggregates, models, refcache, resolvers
+
+    rng = random.Random(seed)
+    grading_systems = seed_reference_data()
+    today = datetime.date.today()
+
+    User.objects.bulk_create([
+        User(username="user{}@example.com".format(i),
+             email="user{}@example.com".format(i))
+        for i in range(accounts)])
+    users = list(User.objects.order_by('id'))
+    models.Accounts.objects.bulk_create([
+        models.Accounts(user=user, create_date=today, valid_id=1,
+                        grading_sys=grading_systems[i % 2],
+                        account_type_id=1, css_style_id=1)
+        for i, user in enumerate(users)])
+
+    # Half year semesters, the last one around today
+    semester_rows = []
+    for user in users:
+        for i in range(semesters):
+            start = today - datetime.timedelta(
+                days=90 + (semesters - 1 - i) * 180)
+            semester_rows.append(models.Semesters(
+                name="Semester {}".format(i + 1), semester_start=start,
+                semester_end=start + datetime.timedelta(days=179),
+                account_id=user.id))
+    models.Semesters.objects.bulk_create(semester_rows)
+    models.Subject.objects.bulk_create([
+        models.Subject(name="Subject {}".format(i), account_id=user.id,
+                       weight=rng.choice([0.5, 1, 1, 2]))
+        for user in users for i in range(subjects)])
+
+    all_semesters = {}
+    for semester in models.Semesters.objects.all():
+        all_semesters.setdefault(semester.account_id, []).append(semester)
+    batch = []
+    for subject in models.Subject.objects.all().iterator():
+        for semester in all_semesters[subject.account_id]:
+            for _ in range(grades):
+                batch.append(models.Grades(
+                    subject=subject, note="",
+                    date=semester.semester_start + datetime.timedelta(
+                        days=rng.randint(0, 179)),
+                    weight=rng.choice([0.5, 1, 1, 2]),
+                    score=rng.randint(0, 100)))
+            if len(batch) >= 1000:
+                models.Grades.objects.bulk_create(batch)
+                batch = []
+    models.Grades.objects.bulk_create(batch)
+
+    aggregates.rebuild_all()
+    # bulk_create doesn't send the signals the caches listen to
+    resolvers.invalidate()
+    refcache.invalidate_all()
+    return [user.id for user in users]
+
+def reset():
+    from django.core.management import call_command
+    call_command('flush', interactive=False, verbosity=0)
+
+
+############## Measurement ###################
+
+def measure(function):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, len(queries), peak
+
+def entry_points(user_id):
+    from grades import back, models
+    context = back.get_account_context(user_id)
+    subject = models.Subject.objects.filter(account_id=user_id).first()
+    grade = models.Grades.objects.filter(subject=subject).first()
+    if context.grading_sys.type == 'c':
+        post = {"grade": "4.5", "total_pts": "", "pts": "", "percent": ""}
+    else:
+        post = {"grade": "", "total_pts": "", "pts": "", "percent": "85"}
+    post.update({"subject": str(subject.id), "weight": "1", "note": "",
+                 "date": datetime.date.today().strftime('%m/%d/%Y')})
+    points = {
+        "dashboard_logic": lambda: back.dashboard_logic(user_id),
+        "insights_logic": lambda: back.insights_logic(user_id),
+        "new_grade": lambda: back.new_grade(Request(user_id, dict(post))),
+        "check_grade_ownership":
+            lambda: back.check_grade_ownership(user_id, grade.id),
+        "get_grade_rows": lambda: back.get_grade_rows(user_id),
+        # What an admin list page or a log of the grades does
+        "grade_listing": lambda: [
+            str(grade) for grade in models.Grades.objects.for_display()
+            .filter(subject__account_id=user_id)],
+    }
+    if context.grading_sys.type == 'r':
+        points["add_representation_to_grades"] = lambda: \
+            list(back.add_representation_to_grades(
+                context.grading_sys, back.get_grades(user_id)))
+    return points
+
+def run(sizes=SIZES, out=sys.stdout):
+    from grades import back, dashcache, queryplans
+    results = {}
+    failures = []
+    for size in sizes:
+        reset()
+        user_ids = generate(*size)
+        # One account of each grading system
+        for user_id in user_ids[:2]:
+            kind = back.get_account_context(user_id).grading_sys.type
+            for name, function in sorted(entry_points(user_id).items()):
+                function()  # warm the process caches
+                # but measure the dashboards uncached
+                dashcache.clear()
+                elapsed, queries, peak = measure(function)
+                results[(size, kind, name)] = (elapsed, queries, peak)
+                out.write("{:<16} {} {:<30} {:>9.2f} ms {:>5} queries "
+                          "{:>9.1f} KiB\n".format(
+                              "x".join(str(n) for n in size), kind, name,
+                              elapsed * 1000, queries, peak / 1024.0))
+            for name, lines in queryplans.full_scans(user_id).items():
+                failures.append("{} {}: full table scan: {}".format(
+                    kind, name, "; ".join(lines)))
+
+    for (size, kind, name), (_, queries, _) in sorted(results.items()):
+        first = results.get((sizes[0], kind, name))
+        if name in CONSTANT and first is not None and queries != first[1]:
+            failures.append("{} {}: {} queries at {}, {} at {}".format(
+                kind, name, first[1], sizes[0], queries, size))
+    for failure in failures:
+        out.write("FAIL " + failure + "\n")
+    return not failures
+
+def main(argv):
+    configure(argv[1] if len(argv) > 1 else ':memory:')
+    return 0 if run() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
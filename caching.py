@@ -0,0 +1,24 @@
+""" Helpers shared by the caches of the grades app
+
+Each cache can keep its state in a django cache named by a setting (so all
+processes see the same versions and entries) instead of only in the
+process.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+
+def cache_for(setting_name):
+    """ The django cache named by the setting, None if it isn't set """
+    alias = getattr(settings, setting_name, None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+def incr_version(cache, key):
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, 1, timeout=None)
@@ -0,0 +1,258 @@
+""" Anonymized cohort comparisons of account averages
+
+A batch job (refresh) puts every account's average into a histogram of 101
+whole percent bins per grading system, per area and per country. The
+histograms are mergeable sketches: an account moving from one bin or cohort
+to another is a -1/+1 delta, so an incremental refresh only recomputes the
+accounts whose cells changed since the last run (or that switched grading
+system or area) and adds their deltas to the stored rows.
+
+The average is the one the insights would show as total for a single
+semester spanning all of the account's semesters: the weighted average of
+each subject over its grades, truncated to int, then averaged with the
+subject weights and truncated again (as in back.get_subjects_average). The
+per subject sums come with SQL from the SubjectAggregate cells and, for
+archived semesters, the SemesterSummary rows. Semesters can't overlap (see
+check_semester) so no grade is counted twice; grades outside of every
+semester aren't counted. Accounts without grades get a member row without a
+bin and stay out of the histograms.
+
+Deleting a whole semester or subject, or changing a subject weight, changes
+averages without touching the other cells, run refresh(full=True) now and
+then (ex. nightly) to pick that up.
+
+percentile() reads a cumulative distribution that is cached per cohort for
+CDF_TTL seconds, so a lookup costs the same no matter how many accounts a
+cohort has. Cohorts smaller than MIN_COHORT are never reported.
+
+The area of an account is Accounts.area, or the only Area using the
+account's grading system if it isn't set.
+"""
+import bisect
+import json
+import threading
+import time
+
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum
+from django.utils import timezone
+
+from grades import models, refcache
+
+BINS = 101
+KINDS = ('g', 'a', 'c')
+# Smallest cohort reported, so a percentile can't single anyone out
+MIN_COHORT = 10
+CDF_TTL = 10 * 60
+CHUNK_SIZE = 1000
+
+_cdfs = {}
+_lock = threading.Lock()
+
+
+def _bin(weighted_sum, weight_sum):
+    if not weight_sum:
+        return None
+    return min(max(int(weighted_sum / weight_sum), 0), BINS - 1)
+
+def _areas_by_grading_sys():
+    areas = {}
+    for area in refcache.get('areas'):
+        areas.setdefault(area.g_id, []).append(area)
+    return dict((g_id, found[0]) for g_id, found in areas.items()
+                if len(found) == 1)
+
+def _cohorts(grading_sys_id, area_id, country_id):
+    return (('g', grading_sys_id), ('a', area_id), ('c', country_id))
+
+def _changed_accounts(since):
+    """ Ids of the accounts to recompute after `since` (None: all) """
+    if since is None:
+        return set(models.Accounts.objects.values_list('user_id', flat=True))
+    changed = set(models.SubjectAggregate.objects
+                  .filter(updated__gte=since)
+                  .values_list('semester__account_id', flat=True).distinct())
+    changed.update(models.Accounts.objects
+                   .filter(cohortmember__isnull=True)
+                   .values_list('user_id', flat=True))
+    # Switched grading system or area
+    changed.update(models.Accounts.objects
+                   .filter(cohortmember__isnull=False)
+                   .exclude(grading_sys_id=F('cohortmember__grading_sys_id'))
+                   .values_list('user_id', flat=True))
+    # Set, cleared or switched area, comparing nulls as equal
+    changed.update(models.Accounts.objects
+                   .filter(cohortmember__isnull=False)
+                   .filter(Q(area__isnull=False,
+                             cohortmember__account_area__isnull=True) |
+                           Q(area__isnull=True,
+                             cohortmember__account_area__isnull=False) |
+                           Q(area__isnull=False,
+                             cohortmember__account_area__isnull=False) &
+                           ~Q(area_id=F('cohortmember__account_area_id')))
+                   .values_list('user_id', flat=True))
+    return changed
+
+def _chunks(ids, size):
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def _averages(account_ids):
+    """ {account id: (sum of subject average * subject weight, sum of
+    subject weights)} as in get_subjects_average """
+    subjects = {}
+    # Archived semesters have summaries instead of cells
+    for model in (models.SubjectAggregate, models.SemesterSummary):
+        for account_id, subject_id, weight, weighted_sum, weight_sum in \
+                model.objects\
+                .filter(semester__account_id__in=account_ids, count__gt=0)\
+                .order_by()\
+                .values_list('semester__account_id', 'subject_id',
+                             'subject__weight')\
+                .annotate(Sum('weighted_sum'), Sum('weight_sum')):
+            sums = subjects.setdefault((account_id, subject_id),
+                                       [0, 0, weight])
+            sums[0] += weighted_sum
+            sums[1] += weight_sum
+    averages = {}
+    for (account_id, _), (weighted_sum, weight_sum, weight) in \
+            subjects.items():
+        # Truncated per subject first, as in make_subject_stats
+        score = int(weighted_sum / weight_sum) if weighted_sum != 0 else 0
+        total = averages.setdefault(account_id, [0, 0])
+        total[0] += score * weight
+        total[1] += weight
+    return averages
+
+def _members(account_ids, areas):
+    """ New CohortMember rows of the accounts (without grades: no bin) """
+    averages = _averages(account_ids)
+    members = {}
+    for account_id, grading_sys_id, area_id in models.Accounts.objects\
+            .filter(user_id__in=account_ids)\
+            .values_list('user_id', 'grading_sys_id', 'area_id'):
+        area = refcache.get_by_id('areas', area_id) if area_id is not None \
+            else areas.get(grading_sys_id)
+        members[account_id] = models.CohortMember(
+            account_id=account_id, grading_sys_id=grading_sys_id,
+            account_area_id=area_id, area_id=area.id if area else None,
+            country_id=area.c_id if area else None,
+            bin=_bin(*averages.get(account_id, (0, 0))))
+    return members
+
+def _add_delta(deltas, member, change):
+    if member.bin is None:
+        return
+    for kind, key in _cohorts(member.grading_sys_id, member.area_id,
+                              member.country_id):
+        if key is not None:
+            bins = deltas.setdefault((kind, key), [0] * BINS)
+            bins[member.bin] += change
+
+def _apply(deltas, started):
+    for (kind, key), delta in deltas.items():
+        histogram = models.CohortHistogram.objects.select_for_update()\
+            .filter(kind=kind, key=key).first()
+        if histogram is None:
+            histogram = models.CohortHistogram(kind=kind, key=key)
+            bins = [0] * BINS
+        else:
+            bins = json.loads(histogram.bins)
+        bins = [count + change for count, change in zip(bins, delta)]
+        histogram.bins = json.dumps(bins)
+        histogram.count = sum(bins)
+        histogram.refreshed = started
+        histogram.save()
+
+def refresh(full=False):
+    """ Update the cohort histograms. Returns the number of accounts that
+    were recomputed """
+    started = timezone.now()
+    since = None
+    if not full:
+        since = models.CohortHistogram.objects\
+            .aggregate(Max('refreshed'))['refreshed__max']
+    areas = _areas_by_grading_sys()
+    changed = _changed_accounts(since)
+    with transaction.atomic():
+        if since is None:
+            models.CohortHistogram.objects.all().delete()
+            models.CohortMember.objects.all().delete()
+        deltas = {}
+        for chunk in _chunks(changed, CHUNK_SIZE):
+            old = models.CohortMember.objects.filter(account_id__in=chunk)
+            new = _members(chunk, areas)
+            for member in old:
+                _add_delta(deltas, member, -1)
+            for member in new.values():
+                _add_delta(deltas, member, 1)
+            old.delete()
+            models.CohortMember.objects.bulk_create(new.values())
+        _apply(deltas, started)
+        # Also marks the run when nothing changed
+        models.CohortHistogram.objects.update(refreshed=started)
+    with _lock:
+        _cdfs.clear()
+    return len(changed)
+
+
+############## Lookups ###################
+
+def _cdf(kind, key):
+    """ (count, cumulative counts per bin), cached for CDF_TTL seconds """
+    now = time.time()
+    entry = _cdfs.get((kind, key))
+    if entry is not None and now < entry[0]:
+        return entry[1]
+    histogram = models.CohortHistogram.objects.filter(kind=kind, key=key)\
+        .values_list('count', 'bins').first()
+    cdf = None
+    if histogram is not None:
+        cumulative = []
+        total = 0
+        for count in json.loads(histogram[1]):
+            total += count
+            cumulative.append(total)
+        cdf = (histogram[0], cumulative)
+    with _lock:
+        _cdfs[(kind, key)] = (now + CDF_TTL, cdf)
+    return cdf
+
+def _percentile(cdf, bin):
+    count, cumulative = cdf
+    below = cumulative[bin - 1] if bin > 0 else 0
+    # Ties count half, so everyone in a one-bin cohort is at 50
+    return 100.0 * (below + (cumulative[bin] - below) / 2.0) / count
+
+def percentile(user_id):
+    """ Percentile of the account's average within its grading system, area
+    and country cohorts, as of the last refresh. Returns {"grading_system",
+    "area", "country"} with None for unknown or too small cohorts (all
+    None if the account has no grades), or None if the account hasn't been
+    counted yet """
+    member = models.CohortMember.objects.filter(account_id=int(user_id))\
+        .first()
+    if member is None:
+        return None
+    output = {}
+    for name, (kind, key) in zip(
+            ("grading_system", "area", "country"),
+            _cohorts(member.grading_sys_id, member.area_id,
+                     member.country_id)):
+        cdf = _cdf(kind, key) if key is not None else None
+        if member.bin is None or cdf is None or cdf[0] < MIN_COHORT:
+            output[name] = None
+        else:
+            output[name] = _percentile(cdf, member.bin)
+    return output
+
+def quantiles(kind, key, fractions=(0.25, 0.5, 0.75)):
+    """ Whole percent at each fraction of the cohort, None if the cohort is
+    unknown or too small """
+    cdf = _cdf(kind, key)
+    if cdf is None or cdf[0] < MIN_COHORT:
+        return None
+    count, cumulative = cdf
+    return [bisect.bisect_left(cumulative, fraction * count)
+            for fraction in fractions]
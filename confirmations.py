@@ -0,0 +1,107 @@
+""" Background sending of the confirmation mails
+
+send() creates the EmailConfirmation rows of users whose address still has
+to be confirmed inside the surrounding transaction, and queues their mails
+after it commits, so registrations don't wait for SMTP and a rolled back
+registration sends nothing. A worker thread sends the mails through the
+configured EMAIL_BACKEND, retrying a failed mail RETRIES times.
+
+A row whose mail couldn't be sent keeps send_at empty, also if the process
+exits with mails still queued. resend_unsent() sends those again, ex. from
+a periodic job.
+
+wait() blocks until the queue is empty, ex. in tests with the locmem or
+file mail backend before looking at the outbox.
+"""
+import logging
+import queue
+import threading
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections, transaction
+
+from email_confirm_la.models import EmailConfirmation
+from email_confirm_la.utils import generate_random_token
+
+logger = logging.getLogger(__name__)
+
+# Attempts after the first one, RETRY_DELAY * attempt seconds apart
+RETRIES = 3
+RETRY_DELAY = 5
+
+_queue = queue.Queue()
+_worker = [None]
+_lock = threading.Lock()
+
+
+def _send(confirmation_id):
+    close_old_connections()
+    try:
+        confirmation = EmailConfirmation.objects.filter(
+            id=confirmation_id, send_at__isnull=True).first()
+        # Sent or confirmed in the meantime
+        if confirmation is not None:
+            confirmation.send()
+    finally:
+        close_old_connections()
+
+def _work():
+    while True:
+        confirmation_id = _queue.get()
+        try:
+            for attempt in range(RETRIES + 1):
+                try:
+                    _send(confirmation_id)
+                    break
+                except Exception:
+                    if attempt == RETRIES:
+                        # The row stays unsent for resend_unsent()
+                        logger.exception("confirmation mail %s failed",
+                                         confirmation_id)
+                    else:
+                        time.sleep(RETRY_DELAY * (attempt + 1))
+        finally:
+            _queue.task_done()
+
+def _start():
+    with _lock:
+        if _worker[0] is None or not _worker[0].is_alive():
+            _worker[0] = threading.Thread(target=_work,
+                                          name='grades-confirmations')
+            _worker[0].daemon = True
+            _worker[0].start()
+
+def _enqueue(confirmation_ids):
+    _start()
+    for confirmation_id in confirmation_ids:
+        _queue.put(confirmation_id)
+
+def send(users):
+    """ Create the confirmations of the users' email addresses and queue
+    their mails """
+    users = list(users)
+    if not users:
+        return
+    content_type = ContentType.objects.get_for_model(users[0])
+    keys = [generate_random_token() for _ in users]
+    EmailConfirmation.objects.bulk_create([
+        EmailConfirmation(content_type=content_type, object_id=user.pk,
+                          email_field_name='email', email=user.email,
+                          confirmation_key=key)
+        for user, key in zip(users, keys)])
+    # bulk_create doesn't set the ids on every database
+    ids = list(EmailConfirmation.objects.filter(confirmation_key__in=keys)
+               .values_list('id', flat=True))
+    transaction.on_commit(lambda: _enqueue(ids))
+
+def resend_unsent():
+    """ Queue the mails of all confirmations that weren't sent. Returns
+    their number """
+    ids = list(EmailConfirmation.objects.filter(send_at__isnull=True)
+               .values_list('id', flat=True))
+    _enqueue(ids)
+    return len(ids)
+
+def wait():
+    _queue.join()
@@ -0,0 +1,164 @@
+""" Versioned cache of the dashboard and insights output
+
+Results are cached per account under the account's data version and the
+current date (semester progress and the current semester depend on it).
+Mutations bump the version with bump(), so stale entries are never read
+again and simply fall out of the LRU. Changes to the grading system rows
+bump a global version with bump_all().
+
+The cache is off unless enabled. Set GRADES_DASHBOARD_CACHE_ALIAS to a
+django cache shared by all the processes to keep versions and results
+there; GRADES_DASHBOARD_CACHE = True alone only enables the in-process tier,
+which is safe with a single process only (one process can't see the bumps
+of another). The in-process tier is an LRU bounded by
+GRADES_DASHBOARD_CACHE_SIZE entries.
+
+With a read replica (see routers) a page computed right after a write could
+read the old rows from the replica and cache them under the new version.
+Accounts written (or pinned to the primary) in the last GRADES_REPLICA_LAG
+seconds, the longest the replica is assumed to lag, are therefore not
+cached; set it to the replication lag you monitor.
+"""
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from grades import caching, routers
+
+VERSION_KEY = 'grades:dashboard:version:{}'
+GLOBAL_VERSION_KEY = 'grades:dashboard:version'
+RESULT_KEY = 'grades:dashboard:{}:{}:{}:{}:{}'
+BUMPED_KEY = 'grades:dashboard:bumped:{}'
+DEFAULT_SIZE = 1000
+# Results can't be reused after the day ends
+RESULT_TIMEOUT = 24 * 60 * 60
+# Seconds the replica is assumed to lag behind the primary at most
+DEFAULT_REPLICA_LAG = 60
+
+_entries = OrderedDict()
+_versions = {}
+_global_version = [0]
+_bumped = {}
+_lock = threading.Lock()
+
+
+def _shared_cache():
+    return caching.cache_for('GRADES_DASHBOARD_CACHE_ALIAS')
+
+def enabled():
+    return _shared_cache() is not None or \
+        getattr(settings, 'GRADES_DASHBOARD_CACHE', False)
+
+def _replica_lag():
+    return getattr(settings, 'GRADES_REPLICA_LAG', DEFAULT_REPLICA_LAG)
+
+def _mark_bumped(account_id):
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(BUMPED_KEY.format(account_id), True, _replica_lag())
+    else:
+        now = time.time()
+        with _lock:
+            if len(_bumped) > _max_size():
+                for id, until in list(_bumped.items()):
+                    if until < now:
+                        del _bumped[id]
+            _bumped[account_id] = now + _replica_lag()
+
+def _recently_bumped(account_id):
+    shared = _shared_cache()
+    if shared is not None:
+        return bool(shared.get_many([BUMPED_KEY.format(None),
+                                     BUMPED_KEY.format(account_id)]))
+    now = time.time()
+    return any(_bumped.get(id, 0) > now for id in (None, account_id))
+
+def _may_be_stale(account_id):
+    """ Whether a result computed now could have read rows the replica
+    doesn't have yet """
+    if routers.replica_alias() is None:
+        return False
+    return routers.is_pinned(account_id) or _recently_bumped(account_id)
+
+def _max_size():
+    return getattr(settings, 'GRADES_DASHBOARD_CACHE_SIZE', DEFAULT_SIZE)
+
+def _version(account_id):
+    shared = _shared_cache()
+    if shared is None:
+        return (_global_version[0], _versions.get(account_id, 0))
+    versions = shared.get_many([GLOBAL_VERSION_KEY,
+                                VERSION_KEY.format(account_id)])
+    return (versions.get(GLOBAL_VERSION_KEY, 0),
+            versions.get(VERSION_KEY.format(account_id), 0))
+
+def _bump(account_id):
+    with _lock:
+        if account_id is None:
+            _global_version[0] += 1
+            _entries.clear()
+        else:
+            _versions[account_id] = _versions.get(account_id, 0) + 1
+    if routers.replica_alias() is not None:
+        _mark_bumped(account_id)
+    shared = _shared_cache()
+    if shared is not None:
+        caching.incr_version(shared, GLOBAL_VERSION_KEY if account_id is None
+                             else VERSION_KEY.format(account_id))
+
+def bump(account_id):
+    # After the commit, so nothing computed from the old data gets cached
+    # under the new version
+    account_id = int(account_id)
+    transaction.on_commit(lambda: _bump(account_id))
+
+def bump_all():
+    transaction.on_commit(lambda: _bump(None))
+
+def get(name, account_id):
+    """ Returns (key, result), result is None on a miss. key is None if
+    the result must not be cached (cache off, or replica maybe behind) """
+    account_id = int(account_id)
+    if not enabled() or _may_be_stale(account_id):
+        return None, None
+    version = _version(account_id)
+    key = RESULT_KEY.format(name, account_id, version[0], version[1],
+                            datetime.date.today().isoformat())
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return key, _entries[key]
+    shared = _shared_cache()
+    result = shared.get(key) if shared is not None else None
+    if result is not None:
+        _store(key, result)
+    return key, result
+
+def _store(key, result):
+    with _lock:
+        _entries[key] = result
+        while len(_entries) > _max_size():
+            _entries.popitem(last=False)
+
+def put(key, result):
+    if key is None:
+        return
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(key, result, RESULT_TIMEOUT)
+    _store(key, result)
+
+def cached(name, account_id, compute):
+    key, result = get(name, account_id)
+    if result is None:
+        result = compute()
+        put(key, result)
+    return result
+
+def clear():
+    with _lock:
+        _entries.clear()
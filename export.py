@@ -0,0 +1,93 @@
+""" Streaming export of an account's grade history
+
+The grades are read as value rows through a chunked (server-side where the
+database supports it) cursor and resolved on the fly, and the output is
+produced as an iterator of text pieces, ex.
+
+    StreamingHttpResponse(export.export_csv(user_id),
+                          content_type='text/csv')
+
+so memory use doesn't depend on the size of the history. Grades of archived
+semesters are included without rehydrating them.
+"""
+import csv
+import heapq
+import json
+
+from grades import archive, back, models
+
+FIELDS = ('semester', 'subject', 'date', 'score', 'weight', 'grade', 'note')
+# Rows joined into one piece of output
+PIECE_ROWS = 100
+
+
+class _Echo(object):
+    """ File-like object handing csv.writer output straight back """
+    def write(self, value):
+        return value
+
+
+def _grade_rows(context):
+    index = back.SemesterIndex(back.get_semesters(context))
+    subjects = dict(back.get_subjects(context).values_list('id', 'name'))
+    resolver = context.resolver
+    grades = models.Grades.objects\
+        .filter(subject__account_id=context.user_id).order_by('date', 'id')\
+        .values_list('id', 'subject_id', 'date', 'score', 'weight', 'note')
+    # Archived semesters are read from their archives, merged in date order
+    grades = heapq.merge(grades.iterator(),
+                         archive.grade_values(context.user_id),
+                         key=lambda row: (row[2], row[0]))
+    for _, subject_id, date, score, weight, note in grades:
+        if context.grading_sys.type == 'c':
+            grade = resolver.grade(score)
+        elif context.grading_sys.type == 'r':
+            representation = resolver.representation(score)
+            grade = representation.representation if representation else ''
+        else:
+            grade = score
+        semester = ', '.join(s.name or '' for s in index.find(date))
+        yield (semester, subjects.get(subject_id, ''), date, score, weight,
+               grade, note)
+
+def _pieces(lines):
+    piece = []
+    for line in lines:
+        piece.append(line)
+        if len(piece) >= PIECE_ROWS:
+            yield ''.join(piece)
+            piece = []
+    if piece:
+        yield ''.join(piece)
+
+def export_csv(user_id):
+    context = back.get_account_context(user_id)
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for piece in _pieces(writer.writerow(row)
+                         for row in _grade_rows(context)):
+        yield piece
+
+def _json_grades(context):
+    first = True
+    for row in _grade_rows(context):
+        grade = dict(zip(FIELDS, row))
+        grade["date"] = grade["date"].isoformat()
+        yield ('' if first else ',') + json.dumps(grade)
+        first = False
+
+def export_json(user_id):
+    context = back.get_account_context(user_id)
+    semesters = [{"name": s.name, "start": s.semester_start.isoformat(),
+                  "end": s.semester_end.isoformat()}
+                 for s in back.get_semesters(context).order_by(
+                     'semester_start')]
+    subjects = [{"name": name, "weight": weight}
+                for name, weight in back.get_subjects(context)
+                .order_by('id').values_list('name', 'weight')]
+    yield '{{"grading_system": {}, "semesters": {}, "subjects": {}, ' \
+        '"grades": ['.format(json.dumps(context.grading_sys.name),
+                             json.dumps(semesters), json.dumps(subjects))
+    for piece in _pieces(_json_grades(context)):
+        yield piece
+    yield ']}'
@@ -0,0 +1,151 @@
+""" Bulk grade import
+
+Rows use the field names of the new grade form (subject, date, grade,
+total_pts, pts, percent, weight, note) and are read one at a time from a CSV
+or JSON lines source. They are validated and resolved in chunks against the
+account's cached grading system and written with bulk_create, all in one
+transaction, so memory stays bounded by the chunk size.
+"""
+import csv
+import datetime
+import json
+from collections import namedtuple
+
+from django.db import transaction
+
+from grades import aggregates, archive, back, dashcache, models, routers
+
+CHUNK_SIZE = 500
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d')
+
+ImportResult = namedtuple('ImportResult', ['created', 'errors'])
+
+
+class RowError(Exception):
+    pass
+
+
+def read_csv(fileobj):
+    return csv.DictReader(fileobj)
+
+def read_json_lines(fileobj):
+    for line in fileobj:
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                # Keep the row so it gets reported with its number
+                yield {"_error": "invalid JSON: {}".format(e)}
+                continue
+            if not isinstance(row, dict):
+                yield {"_error": "row is not an object"}
+                continue
+            yield row
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _field(row, name):
+    value = row.get(name)
+    if value is None:
+        return ''
+    return str(value).strip()
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise RowError("invalid date '{}'".format(value))
+
+def row_subject_id(row):
+    """ Subject id of a row, None if it isn't a number """
+    try:
+        return int(_field(row, 'subject'))
+    except ValueError:
+        return None
+
+def build_grade(context, row, owned_subjects):
+    """ Unsaved Grades of a row, resolved with the account context. Raises
+    RowError, ValueError, ZeroDivisionError or Representative.DoesNotExist
+    for invalid rows """
+    if "_error" in row:
+        raise RowError(row["_error"])
+    subject_id = row_subject_id(row)
+    if subject_id is None or subject_id not in owned_subjects:
+        raise RowError("unknown subject '{}'".format(_field(row, 'subject')))
+    date = _parse_date(_field(row, 'date'))
+    weight = float(_field(row, 'weight') or 1)
+    fields = (_field(row, 'grade'), _field(row, 'total_pts'),
+              _field(row, 'pts'), _field(row, 'percent'))
+    grade, total_points, earned_points, percent = fields
+    # The resolvers need a grade, a percent or both point fields
+    if not (grade or percent or total_points and earned_points):
+        if total_points or earned_points:
+            raise RowError("both total_pts and pts are needed")
+        raise RowError("no grade given")
+    if context.grading_sys.type == 'c':
+        score = back.resolve_grade_percent_c(context.calculative, *fields)
+    else:
+        score = back.resolve_grade_percent_r(context.resolver, *fields)
+    return models.Grades(subject_id=subject_id, note=_field(row, 'note'),
+                         date=date, weight=weight, score=score)
+
+@routers.writes
+def import_grades(user_id, rows, chunk_size=CHUNK_SIZE):
+    """ Import an iterable of row dicts for the account. Returns an
+    ImportResult with the number of created grades and a list of
+    (row number, message) for the rows that were skipped """
+    context = back.get_account_context(user_id)
+    if context.grading_sys.type not in ('c', 'r'):
+        return ImportResult(0, [(0, "grading system doesn't support grades")])
+    created = 0
+    errors = []
+    first_date = last_date = None
+    with transaction.atomic():
+        for chunk in _chunks(enumerate(rows, 1), chunk_size):
+            subject_ids = [row_subject_id(row) for _, row in chunk]
+            owned = back.get_owned_subject_ids(
+                context, [id for id in subject_ids if id is not None])
+            grades = []
+            for row_nr, row in chunk:
+                try:
+                    grade = build_grade(context, row, owned)
+                except (RowError, ValueError, ZeroDivisionError,
+                        models.Representative.DoesNotExist) as e:
+                    errors.append((row_nr, str(e)))
+                    continue
+                grades.append(grade)
+                if first_date is None or grade.date < first_date:
+                    first_date = grade.date
+                if last_date is None or grade.date > last_date:
+                    last_date = grade.date
+            archive.rehydrate_dates(context.user_id,
+                                    [grade.date for grade in grades])
+            models.Grades.objects.bulk_create(grades)
+            created += len(grades)
+        if created:
+            # Rebuild the aggregates of the semesters the grades fell into
+            for semester in models.Semesters.objects.filter(
+                    account_id=context.user_id,
+                    semester_start__lte=last_date,
+                    semester_end__gte=first_date):
+                aggregates.rebuild_semester(semester)
+            dashcache.bump(context.user_id)
+    return ImportResult(created, errors)
+
+@routers.writes
+def import_csv(user_id, fileobj, chunk_size=CHUNK_SIZE):
+    return import_grades(user_id, read_csv(fileobj), chunk_size)
+
+@routers.writes
+def import_json_lines(user_id, fileobj, chunk_size=CHUNK_SIZE):
+    return import_grades(user_id, read_json_lines(fileobj), chunk_size)
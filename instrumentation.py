@@ -0,0 +1,234 @@
+""" Opt-in instrumentation of the back.py entry points
+
+enable() replaces the functions listed in FUNCTIONS on the back module with
+wrappers that record call counts, latency histograms, ORM queries and rows
+fetched (including those of nested calls). disable() puts the original
+functions back, so there is no overhead at all while it is off. Set
+settings.GRADES_INSTRUMENTATION = True to enable it on startup.
+
+snapshot() returns the collected numbers, write_prometheus(path) dumps them
+in the Prometheus text format.
+"""
+import functools
+import os
+import threading
+import time
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+
+from grades import back
+
+FUNCTIONS = (
+    'dashboard_logic', 'insights_logic', 'get_subjects_for_semester',
+    'get_subjects_average', 'get_semester_now', 'get_semesters',
+    'get_subjects', 'get_grades', 'get_grades_date_desc',
+    'add_representation_to_grades', 'get_grade_rows', 'get_account_context',
+    'new_semester', 'edit_semester', 'del_semester', 'new_semesters',
+    'new_subject', 'edit_subject', 'del_subject',
+    'new_grade', 'edit_grade', 'del_grade', 'update_properties', '_register',
+    'check_semester', 'check_semester_ownership', 'check_subject_ownership',
+    'check_grade_ownership', 'get_owned_semester_ids',
+    'get_owned_subject_ids', 'get_owned_grade_ids',
+)
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+_originals = {}
+_original_cursors = None
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class FunctionStats(object):
+    """ Collected numbers of one function
+
+    ** Contents **
+    calls - number of calls
+    errors - calls that raised an exception
+    seconds - total time spent
+    buckets - calls per latency bucket (not cumulative), last one is +Inf
+    queries - ORM queries, including nested calls
+    rows - rows fetched, including nested calls
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.queries = 0
+        self.rows = 0
+
+    def as_dict(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.buckets):
+            total += count
+            cumulative.append((bound, total))
+        return {"calls": self.calls, "errors": self.errors,
+                "seconds": self.seconds, "buckets": cumulative,
+                "queries": self.queries, "rows": self.rows}
+
+
+def _frames():
+    frames = getattr(_local, 'frames', None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+def _count(queries, rows):
+    frames = getattr(_local, 'frames', None)
+    if frames:
+        frames[-1][0] += queries
+        frames[-1][1] += rows
+
+
+class CountingCursorWrapper(CursorWrapper):
+    def execute(self, sql, params=None):
+        _count(1, 0)
+        return super(CountingCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        _count(1, 0)
+        return super(CountingCursorWrapper, self).executemany(sql, param_list)
+
+    def fetchone(self):
+        with self.db.wrap_database_errors:
+            row = self.cursor.fetchone()
+        if row is not None:
+            _count(0, 1)
+        return row
+
+    def fetchmany(self, *args):
+        with self.db.wrap_database_errors:
+            rows = self.cursor.fetchmany(*args)
+        _count(0, len(rows))
+        return rows
+
+    def fetchall(self):
+        with self.db.wrap_database_errors:
+            rows = self.cursor.fetchall()
+        _count(0, len(rows))
+        return rows
+
+
+def _record(name, elapsed, frame, failed):
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = FunctionStats()
+        stats.calls += 1
+        stats.errors += 1 if failed else 0
+        stats.seconds += elapsed
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                stats.buckets[i] += 1
+                break
+        else:
+            stats.buckets[-1] += 1
+        stats.queries += frame[0]
+        stats.rows += frame[1]
+
+def _wrap(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        frames = _frames()
+        frame = [0, 0]
+        frames.append(frame)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            frames.pop()
+            if frames:
+                # Counts of nested calls belong to the caller as well
+                frames[-1][0] += frame[0]
+                frames[-1][1] += frame[1]
+            _record(name, elapsed, frame, failed)
+    return wrapper
+
+
+def enabled():
+    return bool(_originals)
+
+def enable():
+    global _original_cursors
+    with _lock:
+        if _originals:
+            return
+        for name in FUNCTIONS:
+            function = getattr(back, name)
+            _originals[name] = function
+            setattr(back, name, _wrap(name, function))
+        make_cursor = BaseDatabaseWrapper.make_cursor
+        make_debug_cursor = BaseDatabaseWrapper.make_debug_cursor
+        _original_cursors = (make_cursor, make_debug_cursor)
+        BaseDatabaseWrapper.make_cursor = lambda self, cursor: \
+            CountingCursorWrapper(make_cursor(self, cursor), self)
+        BaseDatabaseWrapper.make_debug_cursor = lambda self, cursor: \
+            CountingCursorWrapper(make_debug_cursor(self, cursor), self)
+
+def disable():
+    global _original_cursors
+    with _lock:
+        for name, function in _originals.items():
+            setattr(back, name, function)
+        _originals.clear()
+        if _original_cursors is not None:
+            BaseDatabaseWrapper.make_cursor = _original_cursors[0]
+            BaseDatabaseWrapper.make_debug_cursor = _original_cursors[1]
+            _original_cursors = None
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def snapshot():
+    with _lock:
+        return dict((name, stats.as_dict()) for name, stats in _stats.items())
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+def prometheus_text():
+    lines = []
+    data = sorted(snapshot().items())
+    for metric, key, help in [
+            ('grades_back_calls_total', 'calls', 'Calls of the function'),
+            ('grades_back_errors_total', 'errors',
+             'Calls that raised an exception'),
+            ('grades_back_queries_total', 'queries',
+             'ORM queries issued, including nested calls'),
+            ('grades_back_rows_total', 'rows',
+             'Rows fetched, including nested calls')]:
+        lines.append('# HELP {} {}'.format(metric, help))
+        lines.append('# TYPE {} counter'.format(metric))
+        for name, stats in data:
+            lines.append('{}{{function="{}"}} {}'.format(metric, name,
+                                                         stats[key]))
+    metric = 'grades_back_latency_seconds'
+    lines.append('# HELP {} Latency of the function'.format(metric))
+    lines.append('# TYPE {} histogram'.format(metric))
+    for name, stats in data:
+        for bound, count in stats["buckets"]:
+            lines.append('{}_bucket{{function="{}",le="{}"}} {}'.format(
+                metric, name, _format_bound(bound), count))
+        lines.append('{}_sum{{function="{}"}} {}'.format(metric, name,
+                                                         stats["seconds"]))
+        lines.append('{}_count{{function="{}"}} {}'.format(metric, name,
+                                                           stats["calls"]))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path):
+    # Write to a temporary file first so scrapers never read half a file
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(temporary, path)
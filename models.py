@@ -5,6 +5,33 @@ from django.utils.functional import cached_property
 from django.dispatch import receiver
 from email_confirm_la.signals import post_email_confirmation_confirm
 
+class DisplayQuerySet(models.QuerySet):
+    """ QuerySet with for_display(), which joins the relations __str__
+    walks (display_related), so listing the objects takes one query
+    """
+    display_related = ()
+
+    def for_display(self):
+        return self.select_related(*self.display_related)
+
+class SemestersQuerySet(DisplayQuerySet):
+    display_related = ('account__user',)
+
+class SubjectQuerySet(DisplayQuerySet):
+    display_related = ('account__user',)
+
+class GradesQuerySet(DisplayQuerySet):
+    display_related = ('subject__account__user',)
+
+class RepresentativeQuerySet(DisplayQuerySet):
+    display_related = ('g',)
+
+class CalculativeQuerySet(DisplayQuerySet):
+    display_related = ('g',)
+
+class CalculativeDescripQuerySet(DisplayQuerySet):
+    display_related = ('c__g', 'legend')
+
 @receiver(post_email_confirmation_confirm)
 def post_email_confirmation_confirm_callback(sender, confirmation, **kwargs):
     model_instace = confirmation.content_object
@@ -82,6 +109,7 @@ class Accounts(models.Model):
     valid - ForeignKey to level of account validity
     grading_sys - ForeignKey to gradingsystem to be used with this account
     account_type - ForeignKey on type (free, premium)
+    area - ForeignKey on Area of the user (optional, for the cohorts)
     """
     user = models.OneToOneField(User, unique=True, primary_key=True)
     create_date = models.DateField(null=False)
@@ -93,6 +121,8 @@ class Accounts(models.Model):
                                      null=False)
     css_style = models.ForeignKey(Stylesheet, null=True, default=1)
     sponsored = models.BooleanField(null=False, default=False)
+    area = models.ForeignKey('Area', on_delete=models.SET_NULL, null=True,
+                             blank=True)
 
     def __str__(self):
         return self.user.username
@@ -122,11 +152,23 @@ class Semesters(models.Model):
     semester_end - semester end date
     semester_start - semester start date
     account - ForeignKey relation to Accounts
+    archived - grades moved to a GradeArchive, statistics in
+               SemesterSummary rows
     """
     name = models.CharField(max_length=100, null=True)
     semester_end = models.DateField(null=False)
     semester_start = models.DateField(null=False)
     account = models.ForeignKey(Accounts, null=False)
+    archived = models.BooleanField(null=False, default=False)
+
+    objects = SemestersQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Overlap checks and the current semester lookup
+            models.Index(fields=['account', 'semester_start',
+                                 'semester_end']),
+        ]
 
     def __str__(self):
         return "{} , {} , {}".format(self.account.user.username,
@@ -144,6 +186,8 @@ class Subject(models.Model):
     account = models.ForeignKey(Accounts, on_delete=models.CASCADE, null=False)
     weight = models.FloatField(null=False, default=1)
 
+    objects = SubjectQuerySet.as_manager()
+
     def __str__(self):
         return "{} , {}".format(self.account.user.username, self.name)
 
@@ -161,6 +205,14 @@ class Grades(models.Model):
     weight = models.FloatField(null=False, default=1)
     score = models.FloatField(null=False)
 
+    objects = GradesQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Grades of a subject in a date range and grades by date
+            models.Index(fields=['subject', 'date']),
+        ]
+
     def __str__(self):
         return "{} , {} , {}".format(self.subject.account.user.username,
                                      self.subject.name,  str(self.date))
@@ -230,6 +282,8 @@ class Representative(models.Model):
     legend = models.ForeignKey(Legend, null=False)
     g = models.ForeignKey(GradingSystem, null=False)
 
+    objects = RepresentativeQuerySet.as_manager()
+
     def __str__(self):
         return "{} | {} | {}".format(self.g.name, self.representation, 
                                      str(self.top))
@@ -253,6 +307,8 @@ class Calculative(models.Model):
     bottom_per = models.IntegerField(null=False)
     g = models.ForeignKey(GradingSystem, null=False)
 
+    objects = CalculativeQuerySet.as_manager()
+
     def __str__(self):
         return self.g.name
 
@@ -271,7 +327,141 @@ class CalculativeDescrip(models.Model):
     legend = models.ForeignKey(Legend, null=False)
     c = models.ForeignKey(Calculative, null=False)
 
+    objects = CalculativeDescripQuerySet.as_manager()
+
     def __str__(self):
         return "{} : {} , {} , {}".format(self.c.g.name, str(self.bottom),
                                           str(self.top),
                                           self.legend.description)
+
+class SubjectAggregate(models.Model):
+    """ Running grade statistics of a subject within a semester
+    Kept up to date by the grade and semester mutations so the dashboards
+    don't have to scan the grades
+
+    ** Contents **
+    subject - ForeignKey on subject of the grades
+    semester - ForeignKey on semester the grades fall into
+    weighted_sum - sum of score * weight
+    weight_sum - sum of weight
+    max_score - highest score
+    count - number of grades (rows with 0 are kept as empty cells)
+    updated - time of the last change
+    """
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, null=False)
+    semester = models.ForeignKey(Semesters, on_delete=models.CASCADE,
+                                 null=False)
+    weighted_sum = models.FloatField(null=False, default=0)
+    weight_sum = models.FloatField(null=False, default=0)
+    max_score = models.FloatField(null=False, default=0)
+    count = models.IntegerField(null=False, default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('subject', 'semester')
+
+    def __str__(self):
+        return "{} , {} , {}".format(self.subject_id, self.semester_id,
+                                     str(self.count))
+
+
+############## Archive ###################
+
+class SemesterSummary(models.Model):
+    """ Frozen grade statistics of a subject within an archived semester
+
+    ** Contents **
+    subject - ForeignKey on subject of the grades
+    semester - ForeignKey on the archived semester
+    weighted_sum - sum of score * weight
+    weight_sum - sum of weight
+    max_score - highest score
+    count - number of grades
+    """
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, null=False)
+    semester = models.ForeignKey(Semesters, on_delete=models.CASCADE,
+                                 null=False)
+    weighted_sum = models.FloatField(null=False)
+    weight_sum = models.FloatField(null=False)
+    max_score = models.FloatField(null=False)
+    count = models.IntegerField(null=False)
+
+    class Meta:
+        unique_together = ('subject', 'semester')
+
+    def __str__(self):
+        return "{} , {} , {}".format(self.subject_id, self.semester_id,
+                                     str(self.count))
+
+class GradeArchive(models.Model):
+    """ The raw grades of an archived semester
+
+    ** Contents **
+    semester - the archived semester
+    data - zlib compressed JSON list of [id, subject_id, date, score,
+           weight, note]
+    count - number of grades
+    created - time of archival
+    """
+    semester = models.OneToOneField(Semesters, on_delete=models.CASCADE,
+                                    primary_key=True)
+    data = models.BinaryField(null=False)
+    count = models.IntegerField(null=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} , {}".format(self.semester_id, str(self.count))
+
+
+############## Cohorts ###################
+
+class CohortMember(models.Model):
+    """ Cohorts an account was last counted in, so a refresh can take it
+    out of the histograms again
+
+    ** Contents **
+    account - account counted
+    grading_sys - grading system cohort
+    account_area - Accounts.area when it was counted, to notice changes
+    area - area cohort (null if the area is unknown)
+    country - country cohort (null if the area is unknown)
+    bin - whole percent of the account's average (0 - 100, null if the
+          account has no grades and isn't in the histograms)
+    updated - time of the last change
+    """
+    account = models.OneToOneField(Accounts, on_delete=models.CASCADE,
+                                   primary_key=True)
+    grading_sys = models.ForeignKey(GradingSystem, on_delete=models.CASCADE,
+                                    null=False)
+    account_area = models.ForeignKey(Area, on_delete=models.SET_NULL,
+                                     null=True, related_name='+')
+    area = models.ForeignKey(Area, on_delete=models.SET_NULL, null=True)
+    country = models.ForeignKey(Country, on_delete=models.SET_NULL,
+                                null=True)
+    bin = models.IntegerField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{} , {}".format(self.account_id, str(self.bin))
+
+class CohortHistogram(models.Model):
+    """ Histogram of the account averages of a cohort
+
+    ** Contents **
+    kind - cohort type: g (grading system), a (area), c (country)
+    key - id of the GradingSystem, Area or Country
+    bins - JSON list of 101 counts, one per whole percent
+    count - number of accounts
+    refreshed - start time of the refresh that last wrote the row
+    """
+    kind = models.CharField(max_length=1, null=False)
+    key = models.IntegerField(null=False)
+    bins = models.TextField(null=False)
+    count = models.IntegerField(null=False, default=0)
+    refreshed = models.DateTimeField(null=False)
+
+    class Meta:
+        unique_together = ('kind', 'key')
+
+    def __str__(self):
+        return "{} {} , {}".format(self.kind, str(self.key), str(self.count))
@@ -0,0 +1,142 @@
+""" Cached premium status
+
+Subscription status is looked up through `backend` and cached per account
+until the end of the subscription period (or PENDING_TTL seconds for
+accounts without an active subscription). djstripe webhooks and
+subscription saves drop the cached status of the customer. Sponsored
+accounts never reach the cache.
+
+If settings.GRADES_PREMIUM_CACHE_ALIAS names a django cache the status is
+kept there instead of in the process, so webhooks reach every process.
+Without it a webhook only reaches the process that received it, so the
+status is kept at most LOCAL_TTL seconds, the longest another process can
+lag behind a change.
+
+`backend` can be replaced by any object with a status(user) method
+returning (active, period_end), ex. a fake of the djstripe models in tests.
+"""
+import datetime
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from djstripe import models as djstripe_models
+from djstripe import signals as djstripe_signals
+from djstripe.utils import subscriber_has_active_subscription
+
+from grades import caching
+
+STATUS_KEY = 'grades:premium:{}'
+# Re-check accounts without an active subscription after this many seconds
+PENDING_TTL = 60 * 60
+# Never trust a status longer than this, even if the period is longer
+MAX_TTL = 7 * 24 * 60 * 60
+# Longest a status is kept without GRADES_PREMIUM_CACHE_ALIAS
+LOCAL_TTL = 60
+SUBSCRIPTION_EVENTS = ('customer.subscription.created',
+                       'customer.subscription.updated',
+                       'customer.subscription.deleted',
+                       'invoice.payment_failed',
+                       'invoice.payment_succeeded')
+
+_statuses = {}
+_lock = threading.Lock()
+
+
+class DjstripeBackend(object):
+    def status(self, user):
+        active = subscriber_has_active_subscription(user)
+        period_end = None
+        if active:
+            try:
+                customer = djstripe_models.Customer.objects.get(
+                    subscriber=user)
+                period_end = customer.current_subscription.current_period_end
+            except (djstripe_models.Customer.DoesNotExist, AttributeError):
+                pass
+        return active, period_end
+
+backend = DjstripeBackend()
+
+
+def _shared_cache():
+    return caching.cache_for('GRADES_PREMIUM_CACHE_ALIAS')
+
+def _expiry(active, period_end, now):
+    longest = now + datetime.timedelta(seconds=MAX_TTL)
+    if active and period_end is not None and now < period_end:
+        return min(period_end, longest)
+    return now + datetime.timedelta(seconds=PENDING_TTL)
+
+def is_premium(user, account):
+    if account.sponsored:
+        return True
+    now = timezone.now()
+    shared = _shared_cache()
+    if shared is not None:
+        active = shared.get(STATUS_KEY.format(account.user_id))
+        if active is not None:
+            return active
+    else:
+        status = _statuses.get(account.user_id)
+        if status is not None and now < status[1]:
+            return status[0]
+
+    active, period_end = backend.status(user)
+    expires = _expiry(active, period_end, now)
+    if shared is not None:
+        shared.set(STATUS_KEY.format(account.user_id), active,
+                   int((expires - now).total_seconds()))
+    else:
+        expires = min(expires, now + datetime.timedelta(seconds=LOCAL_TTL))
+        with _lock:
+            _statuses[account.user_id] = (active, expires)
+    return active
+
+def invalidate(user_id=None):
+    shared = _shared_cache()
+    if user_id is None:
+        if shared is not None:
+            # Shared entries expire on their own, there's no key listing
+            return
+        with _lock:
+            _statuses.clear()
+    elif shared is not None:
+        shared.delete(STATUS_KEY.format(user_id))
+    else:
+        with _lock:
+            _statuses.pop(int(user_id), None)
+
+
+def _customer_changed(customer):
+    subscriber_id = getattr(customer, 'subscriber_id', None)
+    invalidate(subscriber_id)
+
+def webhook_received(sender, event, **kwargs):
+    _customer_changed(getattr(event, 'customer', None))
+
+def subscription_changed(sender, instance, **kwargs):
+    _customer_changed(getattr(instance, 'customer', None))
+
+def customer_signal(sender, **kwargs):
+    # subscription_made / cancelled are sent with the customer as sender
+    _customer_changed(sender)
+
+
+for event_type in SUBSCRIPTION_EVENTS:
+    signal = djstripe_signals.WEBHOOK_SIGNALS.get(event_type)
+    if signal is not None:
+        signal.connect(webhook_received,
+                       dispatch_uid='premium:' + event_type)
+for name in ('subscription_made', 'cancelled'):
+    signal = getattr(djstripe_signals, name, None)
+    if signal is not None:
+        signal.connect(customer_signal, dispatch_uid='premium:' + name)
+for name in ('CurrentSubscription', 'Subscription'):
+    model = getattr(djstripe_models, name, None)
+    if model is not None:
+        post_save.connect(subscription_changed, sender=model,
+                          dispatch_uid='premium:save:' + name)
+        post_delete.connect(subscription_changed, sender=model,
+                            dispatch_uid='premium:delete:' + name)
@@ -0,0 +1,97 @@
+""" Bulk account provisioning
+
+Creates users with their accounts in a few queries instead of several per
+user (ex. onboarding a whole class): passwords are hashed on a process pool,
+Users and Accounts are written with bulk_create in one transaction and the
+confirmation mails are handed to the confirmations worker. _register uses
+the same path for a single user.
+
+The number of hashing processes is settings.GRADES_HASH_WORKERS (default:
+number of CPUs). Small batches are hashed in the calling process, where
+starting the pool would cost more than it saves.
+"""
+import datetime
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from grades import confirmations, models, refcache
+
+MIN_PASSWORD_LENGTH = 8
+# Batches smaller than this are hashed without the process pool
+POOL_THRESHOLD = 4
+
+ProvisionResult = namedtuple('ProvisionResult', ['created', 'errors'])
+
+
+def hash_passwords(passwords):
+    passwords = list(passwords)
+    if len(passwords) < POOL_THRESHOLD:
+        return [make_password(password) for password in passwords]
+    workers = getattr(settings, 'GRADES_HASH_WORKERS', None)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(make_password, passwords,
+                             chunksize=max(1, len(passwords) // 32)))
+
+def _validate(rows):
+    """ Returns the (row number, name, email, password) of the usable rows
+    and (row number, message) for the others """
+    valid = []
+    errors = []
+    seen = set()
+    for row_nr, (name, email, password) in enumerate(rows, 1):
+        email = User.objects.normalize_email(email)
+        if not email:
+            errors.append((row_nr, "no email given"))
+        elif len(password) < MIN_PASSWORD_LENGTH:
+            errors.append((row_nr, "password too short"))
+        elif email in seen:
+            errors.append((row_nr, "duplicate email '{}'".format(email)))
+        else:
+            seen.add(email)
+            valid.append((row_nr, name, email, password))
+    taken = set(User.objects.filter(username__in=seen)
+                .values_list('username', flat=True))
+    if taken:
+        errors.extend((row_nr, "email '{}' is taken".format(email))
+                      for row_nr, _, email, _ in valid if email in taken)
+        valid = [row for row in valid if row[2] not in taken]
+    errors.sort()
+    return valid, errors
+
+def provision_accounts(rows, grading_system, account_type=1):
+    """ Create inactive users with accounts from an iterable of
+    (name, email, password) and queue their confirmation mails. Returns a
+    ProvisionResult with the created users (in row order) and a list of
+    (row number, message) for the rows that were skipped
+
+    Raises IntegrityError if an email gets taken concurrently """
+    valid, errors = _validate(rows)
+    if not valid:
+        return ProvisionResult([], errors)
+    hashes = hash_passwords(password for _, _, _, password in valid)
+    now = datetime.datetime.now()
+    valid_level = refcache.get_by_id('account_valids', 1)
+    grading_sys = refcache.get_by_id('grading_systems', grading_system)
+    account_type = refcache.get_by_id('account_types', account_type)
+
+    with transaction.atomic():
+        User.objects.bulk_create([
+            User(username=email, email=email, password=hashed,
+                 first_name=name, is_active=False)
+            for (_, name, email, _), hashed in zip(valid, hashes)])
+        # bulk_create doesn't set the ids on every database
+        by_email = dict((user.username, user) for user in User.objects.filter(
+            username__in=[email for _, _, email, _ in valid]))
+        users = [by_email[email] for _, _, email, _ in valid]
+        models.Accounts.objects.bulk_create([
+            models.Accounts(user=user, create_date=now, valid=valid_level,
+                            grading_sys=grading_sys,
+                            account_type=account_type)
+            for user in users])
+        confirmations.send(users)
+    return ProvisionResult(users, errors)
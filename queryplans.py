@@ -0,0 +1,66 @@
+""" Query plan checks for the hot back.py queries
+
+full_scans runs EXPLAIN on the queries the dashboards depend on and
+returns the ones the database answers with a full table scan. Run it
+against a seeded database; on a nearly empty one the planner may prefer a
+scan regardless of the indexes.
+"""
+import datetime
+
+from django.db import connection
+
+from grades import aggregates, back, models
+
+
+def hot_querysets(user_id):
+    context = back.get_account_context(user_id)
+    today = datetime.date.today()
+    semester = models.Semesters(semester_start=today, semester_end=today,
+                                account_id=context.user_id)
+    return {
+        "get_grades": back.get_grades(context),
+        "get_grades_date_desc": back.get_grades_date_desc(context),
+        "get_semester_now": back.get_semester_now(context),
+        "get_semester_subject_stats":
+            back.get_semester_subject_stats(context, semester),
+        "check_semester": models.Semesters.objects.filter(
+            account_id=context.user_id, semester_start__lte=today,
+            semester_end__gte=today),
+        "check_grade_ownership": models.Grades.objects.filter(
+            id=0, subject__account_id=context.user_id),
+        "grade_stats": aggregates.grade_stats(models.Grades.objects.filter(
+            subject_id=0, date__gte=today, date__lte=today)),
+    }
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [' '.join(str(column) for column in row)
+                for row in cursor.fetchall()]
+
+def _is_full_scan(line, tables):
+    if connection.vendor == 'sqlite':
+        # ex. "SCAN TABLE grades_grades" (older) or "SCAN grades_grades",
+        # index scans read "... USING (COVERING) INDEX ..."
+        if ' SCAN ' not in ' ' + line + ' ' or 'USING' in line:
+            return False
+    elif 'Seq Scan on ' not in line:
+        return False
+    return any(table in line.split() for table in tables)
+
+def full_scans(user_id):
+    """ Returns {query name: [plan lines]} of the queries that fall back to a
+    full scan of Grades or Semesters """
+    tables = (models.Grades._meta.db_table, models.Semesters._meta.db_table)
+    scans = {}
+    for name, queryset in hot_querysets(user_id).items():
+        lines = [line for line in explain(queryset)
+                 if _is_full_scan(line, tables)]
+        if lines:
+            scans[name] = lines
+    return scans
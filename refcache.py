@@ -0,0 +1,116 @@
+""" Process-wide cache of reference data
+
+Grading systems, countries, stylesheets etc. almost never change, so they are
+loaded on first use and kept as evaluated querysets (templates iterate them
+like before, without a query). Every dataset has a version that is bumped by
+the model signals. If settings.GRADES_REFCACHE_ALIAS names a django cache,
+the versions are kept there as well so that a change in one process reloads
+the data in all of them. Without it the signals only reach the process that
+saved the change, so the others reload every LOCAL_TTL seconds; set the
+alias when running several processes.
+
+warm() loads everything at once, ex. from a deployment script.
+"""
+import threading
+import time
+
+from django.db.models.signals import post_save, post_delete
+
+from grades import caching, models
+
+VERSION_KEY = 'grades:refcache:{}'
+# Reload period without GRADES_REFCACHE_ALIAS
+LOCAL_TTL = 5 * 60
+
+_loaders = {}
+_entries = {}
+_versions = {}
+_lock = threading.Lock()
+
+
+def _shared_cache():
+    return caching.cache_for('GRADES_REFCACHE_ALIAS')
+
+def version(name):
+    """ Version of the dataset, or of any other name passed to invalidate(),
+    to tag data derived from it """
+    local = _versions.get(name, 0)
+    shared = _shared_cache()
+    if shared is None:
+        # Changes once per period, which expires the entries made before
+        return (local, int(time.time() // LOCAL_TTL))
+    return (local, shared.get(VERSION_KEY.format(name)))
+
+def register(name, loader, *senders):
+    _loaders[name] = loader
+    for sender in senders:
+        post_save.connect(_invalidator(name), sender=sender, weak=False,
+                          dispatch_uid='refcache:{}:{}'.format(name, sender))
+        post_delete.connect(_invalidator(name), sender=sender, weak=False,
+                            dispatch_uid='refcache:{}:{}'.format(name, sender))
+
+def _invalidator(name):
+    def receiver(sender, **kwargs):
+        invalidate(name)
+    return receiver
+
+def _entry(name):
+    current = version(name)
+    entry = _entries.get(name)
+    if entry is not None and entry[0] == current:
+        return entry
+    queryset = _loaders[name]()
+    len(queryset)  # evaluate once, iterating it later won't hit the database
+    by_id = dict((obj.id, obj) for obj in queryset)
+    entry = (current, queryset, by_id)
+    with _lock:
+        # Keep it only if nothing was invalidated while loading
+        if version(name) == current:
+            _entries[name] = entry
+    return entry
+
+def get(name):
+    return _entry(name)[1]
+
+def get_by_id(name, id):
+    _, queryset, by_id = _entry(name)
+    try:
+        return by_id[int(id)]
+    except KeyError:
+        raise queryset.model.DoesNotExist(
+            "{} matching id {} does not exist.".format(
+                queryset.model.__name__, id))
+
+def invalidate(name):
+    with _lock:
+        _versions[name] = _versions.get(name, 0) + 1
+        _entries.pop(name, None)
+    shared = _shared_cache()
+    if shared is not None:
+        caching.incr_version(shared, VERSION_KEY.format(name))
+
+def invalidate_all():
+    for name in list(_loaders):
+        invalidate(name)
+
+def warm():
+    for name in _loaders:
+        get(name)
+
+
+register('grading_systems',
+         lambda: models.GradingSystem.objects.all().order_by('name'),
+         models.GradingSystem)
+register('countries',
+         lambda: models.Country.objects.all().order_by('name'),
+         models.Country)
+register('stylesheets', lambda: models.Stylesheet.objects.all(),
+         models.Stylesheet)
+register('account_types', lambda: models.AccountType.objects.all(),
+         models.AccountType)
+register('account_valids', lambda: models.AccountValid.objects.all(),
+         models.AccountValid)
+register('legends', lambda: models.Legend.objects.all().order_by('lvl'),
+         models.Legend)
+register('areas', lambda: models.Area.objects.all().select_related('g', 'c'),
+         models.Area, models.GradingSystem, models.Country)
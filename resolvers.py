@@ -0,0 +1,261 @@
+""" Compiled grade resolvers
+
+A GradeResolver holds the representations, descriptions and calculated
+grades of a grading system as lookup tables indexed by percent, so resolving
+a grade is a list index instead of a scan over the database rows.
+Resolvers are built once per process and tagged with the refcache version
+VERSION_NAME, which the model signals below bump when the grading system
+data changes. With GRADES_REFCACHE_ALIAS the version is shared, so a change
+made in one process rebuilds the resolvers of all of them; without it the
+other processes rebuild them every refcache.LOCAL_TTL seconds.
+"""
+import math
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from grades import dashcache, models, refcache
+
+VERSION_NAME = 'resolvers'
+
+# {grading system id: (version, GradeResolver)}
+_resolvers = {}
+_lock = threading.Lock()
+
+
+def calculate_grade(calculative, grade_per):
+    grade_range = calculative.top - calculative.bottom
+    if grade_per == 0:
+        return calculative.bottom
+    elif grade_per > calculative.bottom_per:
+        # calculate difference between 100% and the bottom % and find out how
+        # much of the grade that difference is and add grade bottom
+        upper_diff = 100 - calculative.bottom_per
+        grade_diff = grade_per - calculative.bottom_per
+        grade = ((grade_diff / upper_diff) * grade_range) + calculative.bottom
+        return round(grade, 2)
+    else:
+        grade = (grade_per / calculative.bottom_per) * calculative.bottom
+        return round(grade, 2)
+
+
+class GradeResolver(object):
+    """ Lookup tables of one grading system
+
+    ** Contents **
+    grading_sys - GradingSystem the tables were built for
+    calculative - Calculative of the grading system (type c, else None)
+    descrips - CalculativeDescrip rows (type c)
+    representations - Representative rows (type r)
+    low, high - percent range covered by the tables
+    descrip_table - CalculativeDescrip per percent
+    representation_table - Representative per percent
+    grade_table - calculated grade per percent (type c)
+
+    Bands have integer borders, so a percent p falls in the same band as
+    floor(p) and one table entry per whole percent is enough.
+    """
+    def __init__(self, grading_sys, calculative, descrips, representations):
+        self.grading_sys = grading_sys
+        self.calculative = calculative
+        self.descrips = descrips
+        self.representations = representations
+        self.representations_by_id = dict((r.id, r) for r in representations)
+
+        borders = [0, 100]
+        for band in descrips + representations:
+            borders.append(band.bottom)
+            borders.append(band.top)
+        self.low = min(borders)
+        self.high = max(borders)
+
+        self.lowest_descrip = None
+        for descrip in descrips:
+            if self.lowest_descrip is None or \
+                    self.lowest_descrip.top > descrip.top:
+                self.lowest_descrip = descrip
+
+        size = self.high - self.low + 1
+        self.descrip_table = self._compile(descrips, size)
+        self.representation_table = self._compile(representations, size)
+        if calculative is not None:
+            self.grade_table = [calculate_grade(calculative, self.low + i)
+                                for i in range(size)]
+        else:
+            self.grade_table = None
+
+    def _compile(self, bands, size):
+        table = [None] * size
+        for band in bands:
+            for percent in range(band.bottom, band.top):
+                # The first matching row wins, as in a linear scan
+                if table[percent - self.low] is None:
+                    table[percent - self.low] = band
+        return table
+
+    def _index(self, grade_per):
+        index = int(math.floor(grade_per)) - self.low
+        if 0 <= index < len(self.descrip_table):
+            return index
+        return None
+
+    def representation(self, grade_per):
+        index = self._index(grade_per)
+        if index is None:
+            return None
+        return self.representation_table[index]
+
+    def descrip(self, grade_per):
+        index = self._index(grade_per)
+        if index is None or self.descrip_table[index] is None:
+            # Descriptions don't always go down to 0%
+            return self.lowest_descrip
+        return self.descrip_table[index]
+
+    def grade(self, grade_per):
+        if isinstance(grade_per, int) and self.low <= grade_per <= self.high:
+            return self.grade_table[grade_per - self.low]
+        return calculate_grade(self.calculative, grade_per)
+
+    def representative(self, representative_id):
+        try:
+            return self.representations_by_id[int(representative_id)]
+        except KeyError:
+            raise models.Representative.DoesNotExist(
+                "Representative matching id {} does not exist in {}.".format(
+                    representative_id, self.grading_sys))
+
+
+def build_resolver(grading_sys):
+    calculative = None
+    descrips = []
+    representations = []
+    if grading_sys.type == 'c':
+        calculative = models.Calculative.objects.get(g=grading_sys)
+        descrips = list(models.CalculativeDescrip.objects
+                        .filter(c=calculative).select_related('legend')
+                        .order_by('id'))
+    elif grading_sys.type == 'r':
+        representations = list(models.Representative.objects
+                               .filter(g=grading_sys).select_related('legend')
+                               .order_by('id'))
+    return GradeResolver(grading_sys, calculative, descrips, representations)
+
+
+def build_resolvers(grading_systems):
+    """ build_resolver for several grading systems with one query per
+    table. Returns {grading system id: GradeResolver} """
+    ids = [gs.id for gs in grading_systems]
+    calculatives = dict((c.g_id, c) for c in models.Calculative.objects
+                        .filter(g_id__in=ids).order_by('id'))
+    descrips = {}
+    for descrip in models.CalculativeDescrip.objects\
+            .filter(c__in=list(calculatives.values()))\
+            .select_related('legend').order_by('id'):
+        descrips.setdefault(descrip.c_id, []).append(descrip)
+    representations = {}
+    for representation in models.Representative.objects\
+            .filter(g_id__in=ids).select_related('legend').order_by('id'):
+        representations.setdefault(representation.g_id, []).append(
+            representation)
+
+    built = {}
+    for grading_sys in grading_systems:
+        calculative = None
+        if grading_sys.type == 'c':
+            calculative = calculatives.get(grading_sys.id)
+            if calculative is None:
+                raise models.Calculative.DoesNotExist(
+                    "Calculative matching {} does not exist.".format(
+                        grading_sys))
+        built[grading_sys.id] = GradeResolver(
+            grading_sys, calculative,
+            descrips.get(calculative.id, []) if calculative else [],
+            representations.get(grading_sys.id, [])
+            if grading_sys.type == 'r' else [])
+    return built
+
+
+def _cached(grading_sys_id, version):
+    entry = _resolvers.get(grading_sys_id)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    return None
+
+def _store(built, version):
+    with _lock:
+        # Don't keep resolvers that were built while their data changed
+        if refcache.version(VERSION_NAME) == version:
+            for grading_sys_id, resolver in built.items():
+                _resolvers[grading_sys_id] = (version, resolver)
+
+
+def get_resolver(grading_sys):
+    if not isinstance(grading_sys, models.GradingSystem):
+        grading_sys = refcache.get_by_id('grading_systems', grading_sys)
+    version = refcache.version(VERSION_NAME)
+    resolver = _cached(grading_sys.id, version)
+    if resolver is not None:
+        return resolver
+    resolver = build_resolver(grading_sys)
+    _store({grading_sys.id: resolver}, version)
+    return resolver
+
+
+def get_resolvers(grading_systems):
+    """ get_resolver for several grading systems (instances or ids), the
+    missing ones are built together. Returns {grading system id:
+    GradeResolver} """
+    grading_systems = [
+        gs if isinstance(gs, models.GradingSystem)
+        else refcache.get_by_id('grading_systems', gs)
+        for gs in grading_systems]
+    version = refcache.version(VERSION_NAME)
+    found = {}
+    missing = {}
+    for grading_sys in grading_systems:
+        resolver = _cached(grading_sys.id, version)
+        if resolver is not None:
+            found[grading_sys.id] = resolver
+        else:
+            missing[grading_sys.id] = grading_sys
+    if missing:
+        built = build_resolvers(list(missing.values()))
+        _store(built, version)
+        found.update(built)
+    return found
+
+
+def invalidate(grading_sys_id=None):
+    """ Drop the resolvers of every process. The version is shared by all
+    grading systems, grading_sys_id only frees this process' entry early """
+    with _lock:
+        if grading_sys_id is None:
+            _resolvers.clear()
+        else:
+            _resolvers.pop(grading_sys_id, None)
+    refcache.invalidate(VERSION_NAME)
+    # Cached dashboards hold grades resolved with the old tables
+    dashcache.bump_all()
+
+
+@receiver(post_save, sender=models.GradingSystem)
+@receiver(post_delete, sender=models.GradingSystem)
+def grading_system_changed(sender, instance, **kwargs):
+    invalidate(instance.id)
+
+@receiver(post_save, sender=models.Representative)
+@receiver(post_delete, sender=models.Representative)
+@receiver(post_save, sender=models.Calculative)
+@receiver(post_delete, sender=models.Calculative)
+def grading_rows_changed(sender, instance, **kwargs):
+    invalidate(instance.g_id)
+
+@receiver(post_save, sender=models.CalculativeDescrip)
+@receiver(post_delete, sender=models.CalculativeDescrip)
+@receiver(post_save, sender=models.Legend)
+@receiver(post_delete, sender=models.Legend)
+def description_rows_changed(sender, instance, **kwargs):
+    # Rare admin edits, drop everything instead of looking up the system
+    invalidate()
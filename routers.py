@@ -0,0 +1,153 @@
+""" Read replica routing
+
+back.py marks its functions with @reads or @writes. Queries made inside a
+@reads call go to the replica alias (settings.GRADES_REPLICA_DB, default
+'replica'); everything else, including all writes and any read made inside
+a @writes call, goes to the primary. After a @writes call the account is
+pinned to the primary for GRADES_REPLICA_PIN seconds, so its own reads
+don't see the replica lag (read-your-writes). Querysets returned by a
+@reads function are bound to the database that was chosen for the call.
+
+    DATABASES = {"default": {...}, "replica": {...}}
+    DATABASE_ROUTERS = ['grades.routers.ReplicaRouter']
+
+Without a replica alias in DATABASES, or without ReplicaRouter in
+DATABASE_ROUTERS, everything stays on the primary. Pins are
+kept in the process; with several processes set GRADES_REPLICA_PIN_ALIAS
+to a shared django cache, otherwise a process could read (and cache) an
+account's dashboards from the replica right after another process wrote.
+
+Locally the replica can be a second SQLite file kept in sync by hand (ex.
+copied after migrate), or in tests {"TEST": {"MIRROR": "default"}}.
+"""
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, router
+from django.db.models.query import QuerySet
+
+from grades import caching
+
+PIN_KEY = 'grades:primary:{}'
+DEFAULT_PIN = 5
+
+_state = threading.local()
+_pins = {}
+_lock = threading.Lock()
+
+
+def replica_alias():
+    """ The replica alias, None if there's none or it isn't routed to """
+    alias = getattr(settings, 'GRADES_REPLICA_DB', 'replica')
+    if alias not in settings.DATABASES or not any(
+            isinstance(installed, ReplicaRouter)
+            for installed in router.routers):
+        return None
+    return alias
+
+def _pin_seconds():
+    return getattr(settings, 'GRADES_REPLICA_PIN', DEFAULT_PIN)
+
+def _shared_cache():
+    return caching.cache_for('GRADES_REPLICA_PIN_ALIAS')
+
+def _account_id(args):
+    """ Account of a back.py call, from its user_id, context, request or
+    semester """
+    if not args:
+        return None
+    first = args[0]
+    user_id = getattr(first, 'user_id', None)  # AccountContext
+    if user_id is None:
+        user_id = getattr(first, 'account_id', None)  # Semesters
+    if user_id is None:
+        session = getattr(first, 'session', None)
+        user_id = session.get('member_id') if session is not None else first
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+############## Read-your-writes ###################
+
+def pin(account_id):
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(PIN_KEY.format(account_id), True, _pin_seconds())
+        return
+    with _lock:
+        _pins[account_id] = time.time() + _pin_seconds()
+
+def is_pinned(account_id):
+    if account_id is None:
+        return False
+    shared = _shared_cache()
+    if shared is not None:
+        return shared.get(PIN_KEY.format(account_id)) is not None
+    until = _pins.get(account_id)
+    if until is None:
+        return False
+    if until < time.time():
+        with _lock:
+            _pins.pop(account_id, None)
+        return False
+    return True
+
+
+############## Classification ###################
+
+def _current():
+    return getattr(_state, 'db', None)
+
+def _call(db, function, args, kwargs):
+    previous = _current()
+    _state.db = db
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _state.db = previous
+
+def reads(function):
+    """ Run the function's queries on the replica (see module docstring) """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        replica = replica_alias()
+        if replica is None or _current() == DEFAULT_DB_ALIAS or \
+                is_pinned(_account_id(args)):
+            db = DEFAULT_DB_ALIAS
+        else:
+            db = replica
+        result = _call(db, function, args, kwargs)
+        if isinstance(result, QuerySet) and replica is not None:
+            # Lazy querysets are evaluated after the call returned
+            result = result.using(db)
+        return result
+    return wrapper
+
+def writes(function):
+    """ Keep the function's reads on the primary and pin the account to it
+    afterwards """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return _call(DEFAULT_DB_ALIAS, function, args, kwargs)
+        finally:
+            account_id = _account_id(args)
+            if account_id is not None and replica_alias() is not None:
+                pin(account_id)
+    return wrapper
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return _current()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
@@ -0,0 +1,29 @@
+""" Tests of the grades app
+
+Run them with the test runner of a project that has the app installed
+(manage.py test grades), or standalone from the directory holding the grades
+package:
+
+    python -m unittest discover -s grades/tests -t .
+
+The app targets Django 1.11, which runs on Python 3.7 at the latest.
+
+Standalone runs use the benchmark settings on a temporary SQLite file, with
+a 'replica' alias reading the same file and the URLs of the confirmation
+mails (tests/urls.py).
+"""
+import atexit
+import os
+import tempfile
+
+from django.conf import settings
+
+if not settings.configured:
+    from grades import benchmark
+    _fd, _database = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(_fd)
+    atexit.register(os.remove, _database)
+    benchmark.configure(_database, replica=True, TEMPLATES=[{
+        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "APP_DIRS": True,
+    }], ROOT_URLCONF='grades.tests.urls')
@@ -0,0 +1,35 @@
+""" Helpers shared by the tests """
+from grades import benchmark, dashcache, refcache, resolvers
+
+
+def clear_caches():
+    """ Drop the process caches, the rows they hold are rolled back or
+    flushed between tests """
+    dashcache.clear()
+    refcache.invalidate_all()
+    resolvers.invalidate()
+
+
+class CacheResetMixin(object):
+    def setUp(self):
+        super(CacheResetMixin, self).setUp()
+        clear_caches()
+
+
+class FakeBackend(object):
+    """ Stands in for the djstripe models as premium.backend """
+    def __init__(self, active, period_end=None):
+        self.active = active
+        self.period_end = period_end
+        self.calls = 0
+
+    def status(self, user):
+        self.calls += 1
+        return self.active, self.period_end
+
+
+def generate(accounts=2, semesters=2, subjects=3, grades=5):
+    """ benchmark.generate with a small default size, returns the user ids """
+    user_ids = benchmark.generate(accounts, semesters, subjects, grades)
+    clear_caches()
+    return user_ids
@@ -0,0 +1,58 @@
+import datetime
+
+from django.test import TestCase
+
+from grades import aggregates, back, models
+from grades.benchmark import Request
+from grades.tests import base
+
+
+class AggregateConsistencyTests(base.CacheResetMixin, TestCase):
+    """ The SubjectAggregate cells follow every grade mutation """
+    @classmethod
+    def setUpTestData(cls):
+        # The first account uses the calculative grading system
+        cls.user_id = base.generate()[0]
+
+    def setUp(self):
+        super(AggregateConsistencyTests, self).setUp()
+        self.subject = models.Subject.objects.filter(
+            account_id=self.user_id).order_by('id').first()
+        self.today = datetime.date.today().strftime('%m/%d/%Y')
+
+    def post(self, **fields):
+        post = {"grade": "4.5", "total_pts": "", "pts": "", "percent": "",
+                "subject": str(self.subject.id), "weight": "2", "note": "",
+                "date": self.today}
+        post.update(fields)
+        return Request(self.user_id, post)
+
+    def test_generated_data_is_consistent(self):
+        self.assertEqual(aggregates.check_consistency(), [])
+
+    def test_new_grade(self):
+        back.new_grade(self.post(grade="6"))
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+
+    def test_edit_grade_moving_the_top_score(self):
+        grade = models.Grades.objects.filter(subject=self.subject)\
+            .order_by('-score').first()
+        other = models.Subject.objects.filter(account_id=self.user_id)\
+            .exclude(id=self.subject.id).first()
+        back.edit_grade(self.post(
+            id=str(grade.id), grade="1", subject=str(other.id),
+            date=grade.date.strftime('%m/%d/%Y')))
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+
+    def test_del_grade(self):
+        grade = models.Grades.objects.filter(subject=self.subject)\
+            .order_by('-score').first()
+        back.del_grade(Request(self.user_id, {"id": str(grade.id)}))
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+
+    def test_repair(self):
+        models.SubjectAggregate.objects.filter(
+            semester__account_id=self.user_id).update(count=0)
+        self.assertNotEqual(
+            aggregates.check_consistency(self.user_id, repair=True), [])
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
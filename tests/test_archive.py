@@ -0,0 +1,92 @@
+import datetime
+from unittest import skipIf
+
+from django.test import TestCase
+
+from grades import aggregates, archive, back, models
+from grades.benchmark import Request
+from grades.tests import base
+
+try:
+    from grades import analytics
+except ImportError:
+    analytics = None
+
+
+def insights_digest(user_id):
+    return [(item["semester"].id,
+             [(subject.id, subject.score, subject.nr_grades)
+              for subject in item["subjects"]])
+            for item in back.insights_logic(user_id)]
+
+
+class ArchiveTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # The first account uses the calculative grading system
+        cls.user_id = base.generate(semesters=3)[0]
+
+    def setUp(self):
+        super(ArchiveTests, self).setUp()
+        self.grades = list(models.Grades.objects.filter(
+            subject__account_id=self.user_id).order_by('id')
+            .values_list('id', 'subject_id', 'date', 'score', 'weight',
+                         'note'))
+        self.insights = insights_digest(self.user_id)
+        # All but the current semester
+        self.archived = archive.archive_finished(self.user_id,
+                                                 datetime.date.today())
+
+    def archived_semesters(self):
+        return models.Semesters.objects.filter(account_id=self.user_id,
+                                               archived=True)
+
+    def test_archiving_keeps_the_insights(self):
+        self.assertEqual(self.archived, 2)
+        self.assertEqual(insights_digest(self.user_id), self.insights)
+
+    def test_archived_grades_leave_the_grades_table(self):
+        live = models.Grades.objects.filter(
+            subject__account_id=self.user_id).count()
+        archived = list(archive.grade_values(self.user_id))
+        self.assertLess(live, len(self.grades))
+        self.assertEqual(live + len(archived), len(self.grades))
+        self.assertEqual(archived, sorted(archived,
+                                          key=lambda row: (row[2], row[0])))
+
+    def test_rehydrate_restores_the_grades(self):
+        for semester in self.archived_semesters():
+            archive.rehydrate(semester)
+        self.assertFalse(self.archived_semesters().exists())
+        self.assertEqual(list(models.Grades.objects.filter(
+            subject__account_id=self.user_id).order_by('id')
+            .values_list('id', 'subject_id', 'date', 'score', 'weight',
+                         'note')), self.grades)
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+        self.assertEqual(insights_digest(self.user_id), self.insights)
+
+    def test_new_grade_rehydrates_its_semester(self):
+        semester, other = self.archived_semesters().order_by('semester_start')
+        archived_count = models.GradeArchive.objects.get(
+            semester=semester).count
+        live = models.Grades.objects.filter(
+            subject__account_id=self.user_id).count()
+        subject = models.Subject.objects.filter(
+            account_id=self.user_id).first()
+        back.new_grade(Request(self.user_id, {
+            "grade": "5", "total_pts": "", "pts": "", "percent": "",
+            "subject": str(subject.id), "weight": "1", "note": "",
+            "date": semester.semester_start.strftime('%m/%d/%Y')}))
+        semester.refresh_from_db()
+        other.refresh_from_db()
+        self.assertFalse(semester.archived)
+        # Only the semester holding the date comes back
+        self.assertTrue(other.archived)
+        self.assertEqual(models.Grades.objects.filter(
+            subject__account_id=self.user_id).count(),
+            live + archived_count + 1)
+
+    @skipIf(analytics is None, "needs numpy")
+    def test_analytics_include_archived_grades(self):
+        grades = analytics.load_grades(self.user_id)
+        self.assertEqual(len(grades), len(self.grades))
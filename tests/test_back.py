@@ -0,0 +1,30 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from grades import back, models, premium
+from grades.benchmark import Request
+from grades.tests import base
+
+
+class EntryPointTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_id = base.generate()[0]
+
+    def setUp(self):
+        super(EntryPointTests, self).setUp()
+        patcher = mock.patch.object(premium, 'backend',
+                                    base.FakeBackend(False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_new_subject_accepts_a_context(self):
+        context = back.get_account_context(self.user_id)
+        for user_id in (self.user_id, str(self.user_id), context):
+            subject = back.new_subject(
+                Request(self.user_id, {"name": "Added", "weight": "1"}),
+                user_id)
+            self.assertIsInstance(subject, models.Subject)
+        self.assertEqual(models.Subject.objects.filter(
+            account_id=self.user_id, name="Added").count(), 3)
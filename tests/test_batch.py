@@ -0,0 +1,92 @@
+import datetime
+
+from django.test import TestCase
+
+from grades import aggregates, batch, models
+from grades.tests import base
+
+
+class ApplyTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # The first account uses the calculative grading system
+        cls.user_id, cls.other_id = base.generate()
+
+    def setUp(self):
+        super(ApplyTests, self).setUp()
+        self.subject = models.Subject.objects.filter(
+            account_id=self.user_id).order_by('id').first()
+        self.grade = models.Grades.objects.filter(subject=self.subject)\
+            .order_by('id').first()
+        self.today = datetime.date.today().strftime('%m/%d/%Y')
+
+    def test_mixed_operations(self):
+        results = batch.apply(self.user_id, [
+            {"op": "create", "type": "grade", "subject": self.subject.id,
+             "date": self.today, "grade": "5", "weight": "1"},
+            {"op": "update", "type": "subject", "id": self.subject.id,
+             "name": "Renamed", "weight": "2"},
+            {"op": "delete", "type": "grade", "id": self.grade.id},
+        ])
+        self.assertEqual([result.ok for result in results],
+                         [True, True, True])
+        self.subject.refresh_from_db()
+        self.assertEqual((self.subject.name, self.subject.weight),
+                         ("Renamed", 2))
+        self.assertFalse(models.Grades.objects.filter(
+            id=self.grade.id).exists())
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+
+    def test_update_without_every_field_is_rejected(self):
+        results = batch.apply(self.user_id, [
+            {"op": "update", "type": "subject", "id": self.subject.id,
+             "name": "Renamed"},
+            {"op": "update", "type": "grade", "id": self.grade.id,
+             "subject": self.subject.id, "date": self.today, "grade": "5"},
+        ])
+        self.assertEqual(results[0], batch.OperationResult(
+            False, None, "missing field weight"))
+        self.assertEqual(results[1], batch.OperationResult(
+            False, None, "missing field weight, note"))
+        self.subject.refresh_from_db()
+        self.assertNotEqual(self.subject.name, "Renamed")
+
+    def test_invalid_operations_are_reported(self):
+        foreign = models.Subject.objects.filter(
+            account_id=self.other_id).first()
+        results = batch.apply(self.user_id, [
+            {"op": "create", "type": "semester", "name": "No dates",
+             "start": None, "end": None},
+            {"op": "delete", "type": "subject", "id": foreign.id},
+            {"op": "move", "type": "grade"},
+            {"op": "create", "type": "subject", "name": "Kept",
+             "weight": "1"},
+        ])
+        self.assertEqual([result.ok for result in results],
+                         [False, False, False, True])
+        self.assertTrue(models.Subject.objects.filter(id=foreign.id)
+                        .exists())
+        self.assertTrue(models.Subject.objects.filter(
+            account_id=self.user_id, name="Kept").exists())
+
+    def test_grade_with_partial_points_is_rejected(self):
+        results = batch.apply(self.user_id, [
+            {"op": "create", "type": "grade", "subject": self.subject.id,
+             "date": self.today, "pts": "8"},
+            {"op": "create", "type": "grade", "subject": self.subject.id,
+             "date": self.today, "pts": "8", "total_pts": "10"},
+        ])
+        self.assertEqual(results[0], batch.OperationResult(
+            False, None, "both total_pts and pts are needed"))
+        self.assertTrue(results[1].ok)
+
+    def test_overlapping_semesters_are_rejected(self):
+        semester = models.Semesters.objects.filter(account_id=self.user_id)\
+            .order_by('-semester_start').first()
+        start = semester.semester_start.strftime('%m/%d/%Y')
+        results = batch.apply(self.user_id, [
+            {"op": "create", "type": "semester", "name": "Overlap",
+             "start": start, "end": start},
+        ])
+        self.assertEqual(results, [batch.OperationResult(
+            False, None, "semesters overlap")])
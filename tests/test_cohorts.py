@@ -0,0 +1,69 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from grades import back, cohorts, models
+from grades.tests import base
+
+
+class RefreshTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_ids = base.generate(accounts=4, semesters=3)
+        user = User.objects.create(username="empty@example.com",
+                                   email="empty@example.com")
+        cls.empty = models.Accounts.objects.create(
+            user=user, create_date=datetime.date.today(), valid_id=1,
+            grading_sys=models.GradingSystem.objects.get(type='c'),
+            account_type_id=1, css_style_id=1)
+
+    def member(self, account_id):
+        return models.CohortMember.objects.get(account_id=account_id)
+
+    def test_average_is_the_dashboard_total(self):
+        cohorts.refresh(full=True)
+        for user_id in self.user_ids:
+            semesters = models.Semesters.objects.filter(account_id=user_id)
+            subjects = [back.make_subject_stats(user_id, *row)
+                        for row in back.get_subject_stats_between(
+                            user_id,
+                            min(s.semester_start for s in semesters),
+                            max(s.semester_end for s in semesters))]
+            total = int(sum(s.score * s.weight for s in subjects) /
+                        sum(s.weight for s in subjects))
+            self.assertEqual(self.member(user_id).bin, total)
+
+    def test_accounts_without_grades_stay_out(self):
+        cohorts.refresh(full=True)
+        self.assertIsNone(self.member(self.empty.user_id).bin)
+        histogram = models.CohortHistogram.objects.get(
+            kind='g', key=self.empty.grading_sys_id)
+        self.assertEqual(histogram.count, models.CohortMember.objects.filter(
+            grading_sys_id=self.empty.grading_sys_id, bin__isnull=False)
+            .count())
+        self.assertEqual(cohorts.percentile(self.empty.user_id),
+                         {"grading_system": None, "area": None,
+                          "country": None})
+        # and aren't recomputed when nothing changed
+        self.assertEqual(cohorts.refresh(), 0)
+
+    def test_area_changes_are_picked_up(self):
+        cohorts.refresh(full=True)
+        area = models.Area.objects.create(
+            name="Zurich", g_id=self.empty.grading_sys_id,
+            c=models.Country.objects.create(name="Switzerland"))
+        account = models.Accounts.objects.get(user_id=self.user_ids[0])
+        account.area = area
+        account.save()
+        self.assertEqual(cohorts.refresh(), 1)
+        self.assertEqual(self.member(account.user_id).account_area_id,
+                         area.id)
+
+        account.area = None
+        account.save()
+        self.assertEqual(cohorts.refresh(), 1)
+        member = self.member(account.user_id)
+        self.assertIsNone(member.account_area_id)
+        # The only area of the grading system is still the fallback
+        self.assertEqual(member.area_id, area.id)
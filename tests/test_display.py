@@ -0,0 +1,36 @@
+from django.test import TestCase
+
+from grades import models
+from grades.tests import base
+
+ROWS = 1000
+
+
+class ForDisplayTests(base.CacheResetMixin, TestCase):
+    """ Listing many objects with for_display() takes one query, not one
+    per object and relation """
+    @classmethod
+    def setUpTestData(cls):
+        base.generate(accounts=10, semesters=ROWS // 10, subjects=1,
+                      grades=1)
+        grading_sys = models.GradingSystem.objects.get(type='r')
+        legend = models.Legend.objects.first()
+        models.Representative.objects.bulk_create([
+            models.Representative(bottom=i % 100, top=i % 100 + 1,
+                                  representation=str(i), legend=legend,
+                                  g=grading_sys)
+            for i in range(ROWS)])
+
+    def assertListedInOneQuery(self, queryset):
+        with self.assertNumQueries(1):
+            listed = [str(obj) for obj in queryset.for_display()]
+        self.assertGreaterEqual(len(listed), ROWS)
+
+    def test_grades(self):
+        self.assertListedInOneQuery(models.Grades.objects.all())
+
+    def test_semesters(self):
+        self.assertListedInOneQuery(models.Semesters.objects.all())
+
+    def test_representatives(self):
+        self.assertListedInOneQuery(models.Representative.objects.all())
@@ -0,0 +1,53 @@
+import datetime
+import io
+import json
+
+from django.test import TestCase
+
+from grades import aggregates, importer, models
+from grades.tests import base
+
+
+class ImportTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # The first account uses the calculative grading system
+        cls.user_id = base.generate()[0]
+
+    def setUp(self):
+        super(ImportTests, self).setUp()
+        self.subject = models.Subject.objects.filter(
+            account_id=self.user_id).order_by('id').first()
+        self.today = datetime.date.today().isoformat()
+
+    def row(self, **fields):
+        row = {"subject": self.subject.id, "date": self.today}
+        row.update(fields)
+        return row
+
+    def test_invalid_rows_are_reported(self):
+        before = models.Grades.objects.filter(subject=self.subject).count()
+        result = importer.import_grades(self.user_id, [
+            self.row(grade="5"),
+            self.row(pts="8"),
+            self.row(total_pts="10"),
+            self.row(),
+            self.row(total_pts="10", pts="8"),
+        ])
+        self.assertEqual(result.created, 2)
+        self.assertEqual(result.errors, [
+            (2, "both total_pts and pts are needed"),
+            (3, "both total_pts and pts are needed"),
+            (4, "no grade given")])
+        self.assertEqual(models.Grades.objects.filter(
+            subject=self.subject).count(), before + 2)
+        self.assertEqual(aggregates.check_consistency(self.user_id), [])
+
+    def test_json_lines(self):
+        lines = "\n".join([json.dumps(self.row(percent="80")), "[1, 2]",
+                           "{not json"])
+        result = importer.import_json_lines(self.user_id,
+                                            io.StringIO(lines))
+        self.assertEqual(result.created, 1)
+        self.assertEqual([row_nr for row_nr, _ in result.errors], [2, 3])
+        self.assertEqual(result.errors[0][1], "row is not an object")
@@ -0,0 +1,57 @@
+import datetime
+from collections import namedtuple
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from grades import premium
+from grades.tests.base import FakeBackend
+
+Account = namedtuple('Account', ['user_id', 'sponsored'])
+
+
+class PremiumCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2020, 1, 1)
+        self.backend = FakeBackend(
+            True, self.now + datetime.timedelta(days=30))
+        self.account = Account(user_id=1, sponsored=False)
+        for patcher in (mock.patch.object(premium, 'backend', self.backend),
+                        mock.patch('grades.premium.timezone.now',
+                                   lambda: self.now)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        premium.invalidate()
+        caches['default'].clear()
+
+    def test_sponsored_accounts_skip_the_backend(self):
+        self.assertTrue(premium.is_premium(None, Account(2, True)))
+        self.assertEqual(self.backend.calls, 0)
+
+    def test_status_is_cached(self):
+        self.assertTrue(premium.is_premium(None, self.account))
+        self.assertTrue(premium.is_premium(None, self.account))
+        self.assertEqual(self.backend.calls, 1)
+
+    def test_local_status_expires_after_local_ttl(self):
+        premium.is_premium(None, self.account)
+        self.now += datetime.timedelta(seconds=premium.LOCAL_TTL + 1)
+        premium.is_premium(None, self.account)
+        self.assertEqual(self.backend.calls, 2)
+
+    def test_invalidate_drops_the_status(self):
+        self.assertTrue(premium.is_premium(None, self.account))
+        self.backend.active = False
+        premium.invalidate(self.account.user_id)
+        self.assertFalse(premium.is_premium(None, self.account))
+        self.assertEqual(self.backend.calls, 2)
+
+    @override_settings(GRADES_PREMIUM_CACHE_ALIAS='default')
+    def test_shared_status(self):
+        self.assertTrue(premium.is_premium(None, self.account))
+        self.assertTrue(premium.is_premium(None, self.account))
+        self.assertEqual(self.backend.calls, 1)
+        self.backend.active = False
+        premium.invalidate(self.account.user_id)
+        self.assertFalse(premium.is_premium(None, self.account))
@@ -0,0 +1,90 @@
+import smtplib
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+
+from email_confirm_la.models import EmailConfirmation
+
+from grades import benchmark, confirmations, models, provisioning
+from grades.tests import base
+
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise smtplib.SMTPException("unavailable")
+
+
+class ProvisionAccountsTests(base.CacheResetMixin, TransactionTestCase):
+    def setUp(self):
+        super(ProvisionAccountsTests, self).setUp()
+        self.grading_sys = benchmark.seed_reference_data()[0]
+        base.clear_caches()
+        mail.outbox = []
+
+    def test_creates_users_accounts_and_mails(self):
+        result = provisioning.provision_accounts([
+            ("Ann", "ann@example.com", "secret-one"),
+            ("Bob", "bob@example.com", "secret-two"),
+            ("Short", "short@example.com", "short"),
+            ("Again", "ann@example.com", "secret-three"),
+        ], self.grading_sys.id)
+        self.assertEqual([user.username for user in result.created],
+                         ["ann@example.com", "bob@example.com"])
+        self.assertEqual(result.errors, [
+            (3, "password too short"),
+            (4, "duplicate email 'ann@example.com'")])
+        for user in User.objects.filter(username__in=["ann@example.com",
+                                                      "bob@example.com"]):
+            self.assertFalse(user.is_active)
+            self.assertTrue(user.check_password(
+                "secret-one" if user.first_name == "Ann" else "secret-two"))
+        self.assertEqual(models.Accounts.objects.filter(
+            grading_sys=self.grading_sys).count(), 2)
+
+        confirmations.wait()
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ["ann@example.com", "bob@example.com"])
+
+    def test_taken_email_is_reported(self):
+        User.objects.create(username="ann@example.com",
+                            email="ann@example.com")
+        result = provisioning.provision_accounts(
+            [("Ann", "ann@example.com", "secret-one")], self.grading_sys.id)
+        self.assertEqual(result.created, [])
+        self.assertEqual(result.errors,
+                         [(1, "email 'ann@example.com' is taken")])
+
+    def test_rolled_back_registration_sends_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                provisioning.provision_accounts(
+                    [("Ann", "ann@example.com", "secret-one")],
+                    self.grading_sys.id)
+                raise RuntimeError
+        confirmations.wait()
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(User.objects.exists())
+
+    def test_failed_mails_can_be_resent(self):
+        with mock.patch.object(confirmations, 'RETRY_DELAY', 0), \
+                override_settings(EMAIL_BACKEND='grades.tests.'
+                                  'test_provisioning.FailingBackend'), \
+                self.assertLogs('grades.confirmations', 'ERROR'):
+            provisioning.provision_accounts(
+                [("Ann", "ann@example.com", "secret-one")],
+                self.grading_sys.id)
+            confirmations.wait()
+        self.assertEqual(mail.outbox, [])
+        self.assertTrue(EmailConfirmation.objects.filter(
+            email="ann@example.com", send_at__isnull=True).exists())
+
+        self.assertEqual(confirmations.resend_unsent(), 1)
+        confirmations.wait()
+        self.assertEqual([message.to for message in mail.outbox],
+                         [["ann@example.com"]])
+        self.assertFalse(EmailConfirmation.objects.filter(
+            send_at__isnull=True).exists())
@@ -0,0 +1,15 @@
+from django.test import TestCase
+
+from grades import queryplans
+from grades.tests import base
+
+
+class FullScanTests(base.CacheResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_ids = base.generate(4, 4, 8, 20)
+
+    def test_hot_queries_use_indexes(self):
+        # One account of each grading system
+        for user_id in self.user_ids[:2]:
+            self.assertEqual(queryplans.full_scans(user_id), {})
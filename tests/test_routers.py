@@ -0,0 +1,73 @@
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from grades import archive, back, dashcache, importer, routers
+from grades.tests import base
+
+REPLICA = 'replica'
+
+
+@skipUnless(REPLICA in settings.DATABASES, "needs a 'replica' database")
+@override_settings(DATABASE_ROUTERS=['grades.routers.ReplicaRouter'],
+                   GRADES_REPLICA_DB=REPLICA)
+class ReplicaRouterTests(base.CacheResetMixin, TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        super(ReplicaRouterTests, self).setUp()
+        self.user_ids = base.generate()
+        # Without the pins and bumps of the setup
+        for patcher in (mock.patch.dict(routers._pins, clear=True),
+                        mock.patch.dict(dashcache._bumped, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def count_queries(self, function):
+        """ Returns (queries on the primary, queries on the replica) """
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary:
+            with CaptureQueriesContext(connections[REPLICA]) as replica:
+                function()
+        return len(primary), len(replica)
+
+    def test_reads_go_to_the_replica(self):
+        # The queryset is evaluated after the call returned
+        primary, replica = self.count_queries(
+            lambda: list(back.get_semesters(self.user_ids[0])))
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_writes_stay_on_the_primary(self):
+        primary, replica = self.count_queries(
+            lambda: importer.import_grades(self.user_ids[0], []))
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_writes_pin_the_account_to_the_primary(self):
+        importer.import_grades(self.user_ids[0], [])
+        primary, replica = self.count_queries(
+            lambda: list(back.get_semesters(self.user_ids[0])))
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+        # Other accounts still read from the replica
+        primary, replica = self.count_queries(
+            lambda: list(back.get_semesters(self.user_ids[1])))
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_archiving_pins_the_account(self):
+        semester = back.get_semesters(self.user_ids[0]).first()
+        archive.rehydrate(semester)
+        self.assertTrue(routers.is_pinned(self.user_ids[0]))
+
+    @override_settings(GRADES_DASHBOARD_CACHE=True)
+    def test_recently_written_accounts_are_not_cached(self):
+        dashcache.bump(self.user_ids[0])
+        self.assertEqual(dashcache.get('dashboard', self.user_ids[0]),
+                         (None, None))
+        key, result = dashcache.get('dashboard', self.user_ids[1])
+        self.assertIsNotNone(key)
+        self.assertIsNone(result)
@@ -0,0 +1,5 @@
+from django.conf.urls import include, url
+
+urlpatterns = [
+    url(r'^email/', include(('email_confirm_la.urls', 'email_confirm_la'))),
+]